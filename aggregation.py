@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+from data_processing import TIME_BINS, time_bins
+from metrics import instrumented
+
+# Dropdown value that shows plain trip counts instead of a breakdown
+TOTAL = 'distr'
+
+# Values of the color dropdown, each one becomes a dimension of the count cube
+COLOR_DIMENSIONS = ['education_category', 'range_income', 'gender', 'age', 'mode', TOTAL]
+
+# Columns of a box-plot summary
+BOX_COLUMNS = ['label', 'color', 'q1', 'median', 'q3', 'min', 'max', 'mean', 'count', 'lowerfence', 'upperfence']
+
+
+def color_values(df, color_value):
+    # Column used to split the bars, 'distr' is a single 'count' group
+    if color_value == TOTAL or color_value not in df:
+        return pd.Series(pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), categories=['count']), index=df.index)
+    return df[color_value]
+
+
+def time_counts(df, color_value):
+    # Trips per (label, time bin, color), the only rows a histogram needs
+    counts = (
+        df.assign(color=color_values(df, color_value))
+        .groupby(['label', 'time_range', 'color'], observed=True, sort=True)
+        .size()
+        .rename('count')
+        .reset_index()
+    )
+    return counts[counts['count'] > 0]
+
+
+def time_box_stats(df, color_value, column='start_time'):
+    # Box-plot summary per (label, color): quartiles, whiskers clipped to the data range, and the mean
+    if df.empty:
+        # Every trip was dropped during enrichment, there is nothing to summarize
+        return pd.DataFrame(columns=BOX_COLUMNS)
+    grouped = df.assign(color=color_values(df, color_value)).groupby(['label', 'color'], observed=True, sort=True)[column]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ['q1', 'median', 'q3']
+    stats['min'] = grouped.min()
+    stats['max'] = grouped.max()
+    stats['mean'] = grouped.mean()
+    stats['count'] = grouped.size()
+    iqr = stats['q3'] - stats['q1']
+    stats['lowerfence'] = np.maximum(stats['min'], stats['q1'] - 1.5 * iqr)
+    stats['upperfence'] = np.minimum(stats['max'], stats['q3'] + 1.5 * iqr)
+    return stats.reset_index()
+
+
+def percent_of_bin(counts):
+    # Share of each color within its (label, time bin), as barnorm='percent' did
+    totals = counts.groupby(['label', 'time_range'], observed=True)['count'].transform('sum')
+    return counts.assign(count=100 * counts['count'] / totals)
+
+
+def codes(values, categories):
+    # Position of every value in categories, -1 for values that are not in them
+    return pd.Index(categories).get_indexer(pd.Index(values)).tolist()
+
+
+def cube_dimension(counts, boxes, labels):
+    groups = list(dict.fromkeys(counts['color']))
+    return {
+        'groups': [str(group) for group in groups],
+        'label': codes(counts['label'], labels),
+        'time': counts['time_range'].astype(int).tolist(),
+        'group': codes(counts['color'], groups),
+        'count': counts['count'].astype(int).tolist(),
+        'boxes': {
+            'label': codes(boxes['label'], labels),
+            'group': codes(boxes['color'], groups),
+            **{stat: boxes[stat].astype(float).round(1).tolist() for stat in ['q1', 'median', 'q3', 'lowerfence', 'upperfence', 'mean']},
+        },
+    }
+
+
+@instrumented('count_cube')
+def count_cube(df, dimensions=COLOR_DIMENSIONS, time_bin=min(TIME_BINS)):
+    # Counts per label x time bin x group for every dimension, at the finest bin so the browser can re-bin.
+    # Columns are stored as plain lists of codes to keep the JSON small.
+    binned = df.assign(time_range=time_bins(df['start_time'], time_bin))
+    labels = list(dict.fromkeys(time_counts(binned, TOTAL)['label']))
+    cube = {'time_bin': time_bin, 'labels': [str(label) for label in labels], 'dimensions': {}}
+
+    for dimension in dimensions:
+        cube['dimensions'][dimension] = cube_dimension(time_counts(binned, dimension), time_box_stats(df, dimension), labels)
+    return cube
+
+
+def time_distribution(df, color_value, column='start_time'):
+    # Trips per (label, color, second), enough to recover the exact box statistics after summing chunks
+    return (
+        df.assign(color=color_values(df, color_value))
+        .groupby(['label', 'color', column], observed=True, sort=True)
+        .size()
+        .rename('count')
+        .reset_index()
+    )
+
+
+def distribution_box_stats(distribution, column='start_time'):
+    # time_box_stats from (value, count) rows, quantiles interpolated linearly as pandas does
+    rows = []
+    for (label, color), group in distribution.groupby(['label', 'color'], observed=True, sort=True):
+        group = group.sort_values(column)
+        values = group[column].to_numpy(np.float64)
+        ends = np.cumsum(group['count'].to_numpy(np.int64))
+        stats = {'label': label, 'color': color, 'min': values[0], 'max': values[-1], 'count': ends[-1]}
+        for stat, q in [('q1', 0.25), ('median', 0.5), ('q3', 0.75)]:
+            position = q * (ends[-1] - 1)
+            below, above = values[np.searchsorted(ends, [np.floor(position), np.ceil(position)], side='right')]
+            stats[stat] = below + (above - below) * (position - np.floor(position))
+        stats['mean'] = (values * group['count'].to_numpy(np.float64)).sum() / ends[-1]
+        rows.append(stats)
+    stats = pd.DataFrame(rows, columns=['label', 'color', 'q1', 'median', 'q3', 'min', 'max', 'mean', 'count'])
+    iqr = stats['q3'] - stats['q1']
+    stats['lowerfence'] = np.maximum(stats['min'], stats['q1'] - 1.5 * iqr)
+    stats['upperfence'] = np.minimum(stats['max'], stats['q3'] + 1.5 * iqr)
+    return stats
+
+
+def cube_parts(df, dimensions=COLOR_DIMENSIONS, time_bin=min(TIME_BINS)):
+    # Additive pieces of a count cube: trips per time bin and trips per second for the box statistics
+    binned = df.assign(time_range=time_bins(df['start_time'], time_bin))
+    return {dimension: (time_counts(binned, dimension), time_distribution(df, dimension)) for dimension in dimensions}
+
+
+def sum_counts(frames, keys):
+    return pd.concat(frames, ignore_index=True).groupby(keys, observed=True, sort=True)['count'].sum().reset_index()
+
+
+def add_cube_parts(parts, more):
+    # Fold one chunk into the running parts, their size is bounded by labels x groups x seconds of the day
+    if parts is None:
+        return more
+    return {
+        dimension: (
+            sum_counts([counts, more[dimension][0]], ['label', 'time_range', 'color']),
+            sum_counts([distribution, more[dimension][1]], ['label', 'color', 'start_time']),
+        )
+        for dimension, (counts, distribution) in parts.items()
+    }
+
+
+def parts_cube(parts, time_bin=min(TIME_BINS)):
+    # The count cube count_cube would build from the whole frame the parts were summed from
+    labels = list(dict.fromkeys(parts[TOTAL][0]['label']))
+    cube = {'time_bin': time_bin, 'labels': [str(label) for label in labels], 'dimensions': {}}
+    for dimension, (counts, distribution) in parts.items():
+        cube['dimensions'][dimension] = cube_dimension(counts[counts['count'] > 0], distribution_box_stats(distribution), labels)
+    return cube
+
+
+def merge_cubes(cubes, labels=None):
+    # Every partition cube covers its own labels, so combining them only re-indexes labels and groups.
+    # Removing a scenario is merging the remaining cubes, nothing is recounted.
+    merged = {'time_bin': cubes[0]['time_bin'] if cubes else min(TIME_BINS), 'labels': [], 'dimensions': {}}
+    for cube in cubes:
+        label_offset = len(merged['labels'])
+        merged['labels'] += cube['labels']
+        for dimension, data in cube['dimensions'].items():
+            target = merged['dimensions'].setdefault(dimension, {
+                'groups': [], 'label': [], 'time': [], 'group': [], 'count': [],
+                'boxes': {key: [] for key in data['boxes']},
+            })
+            group_codes = []
+            for group in data['groups']:
+                if group not in target['groups']:
+                    target['groups'].append(group)
+                group_codes.append(target['groups'].index(group))
+            target['label'] += [code + label_offset for code in data['label']]
+            target['group'] += [group_codes[code] for code in data['group']]
+            target['time'] += data['time']
+            target['count'] += data['count']
+            for key, values in data['boxes'].items():
+                if key == 'label':
+                    values = [code + label_offset for code in values]
+                elif key == 'group':
+                    values = [group_codes[code] for code in values]
+                target['boxes'][key] += values
+    if labels is not None:
+        merged['labels'] = list(labels)
+    return merged
+
+
+def cube_counts(cube, dimension=TOTAL, time_bin=None):
+    # Counts of one cube dimension as a DataFrame, re-binned to time_bin minutes
+    data = cube['dimensions'][dimension]
+    counts = pd.DataFrame({
+        'label': np.array(cube['labels'], dtype=object)[np.array(data['label'], dtype=int)],
+        'time_range': time_bins(np.array(data['time'], dtype=np.int64), time_bin or cube['time_bin']),
+        'color': np.array(data['groups'], dtype=object)[np.array(data['group'], dtype=int)],
+        'count': data['count'],
+    })
+    return counts.groupby(['label', 'time_range', 'color'], sort=False)['count'].sum().reset_index()
+
+
+def cube_boxes(cube, dimension=TOTAL):
+    data = cube['dimensions'][dimension]['boxes']
+    boxes = pd.DataFrame({key: values for key, values in data.items() if key not in ('label', 'group')})
+    boxes['label'] = np.array(cube['labels'], dtype=object)[np.array(data['label'], dtype=int)]
+    boxes['color'] = np.array(cube['dimensions'][dimension]['groups'], dtype=object)[np.array(data['group'], dtype=int)]
+    return boxes
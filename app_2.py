@@ -15,16 +15,18 @@ documentation: https://dash.plot.ly/urls
 import dash
 import dash_bootstrap_components as dbc
 from dash import Input, Output, dcc, html
-from dash.dependencies import Input, Output, State
-import pandas as pd
-import plotly.express as px
-import numpy as np
-import geopandas as gpd
-from keplergl import KeplerGl
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
-from data_processing import process_files
-
-from visualization import create_histogram_plot
+from cache import cached_comparison, cached_density_figure, cached_histogram_cube, dataset_key, dataset_labels
+from comparison import DEMOGRAPHICS, comparison_figure, summary_table
+from uploads import register_upload_routes, upload_sources
+from exports import map_url, od_export_url, register_export_routes
+from health import register_health_routes
+from metrics import register_metrics_routes
+from scenario_store import list_scenarios
+from jobs import cancel_job, has_job_preview, job_status, load_job_preview, load_job_result, submit_job
+from data_processing import DEFAULT_TIME_BIN, TIME_BINS, scenario_label
+from rasters import relayout_bounds
 
 
 PLOTLY_LOGO = "https://images.plot.ly/logo/new-branding/plotly-logomark.png"
@@ -32,6 +34,11 @@ PLOTLY_LOGO = "https://images.plot.ly/logo/new-branding/plotly-logomark.png"
 app = dash.Dash(
     external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME]
 )
+server = app.server
+register_upload_routes(server)
+register_export_routes(server)
+register_metrics_routes(server)
+register_health_routes(server)
 
 sidebar = html.Div(
     [
@@ -103,8 +110,24 @@ vc_content = html.Div(
                         },
                     id='upload-data',
                     multiple=True),
+                html.Div(
+                    [
+                        html.Button('Upload Large Files', id='chunked-upload-button', n_clicks=0),
+                        html.Span(id='chunked-upload-status'),
+                        html.Button(id='chunked-upload-done', n_clicks=0, style={'display': 'none'}),
+                        dcc.Store(id='spooled-uploads'),
+                        ]
+                    ),
                 html.Div(id='file-list'),
                 html.Button('Process Files', id='transform-button', n_clicks=0),
+                html.Button('Cancel', id='cancel-button', n_clicks=0),
+                dcc.Store(id='job-id'),
+                dcc.Store(id='preview-job'),
+                dcc.Store(id='dataset-key'),
+                dcc.Interval(id='job-interval', interval=1000, disabled=True),
+                dcc.Dropdown(id='loaded-scenarios', multi=True, placeholder='Scenarios to compare'),
+                html.Div(id='job-progress'),
+                html.Div(id='cancel-message'),
                 html.Hr(),
                 dcc.Loading(
                     id='loading',
@@ -125,10 +148,58 @@ vc_content = html.Div(
                                     value='distr',
                                     clearable=False,
                                     style={'display': 'none'}
+                                    ),
+                                dcc.Dropdown(
+                                    id='time-bin-dropdown',
+                                    options=[
+                                        {'label': f'{minutes} min', 'value': minutes} for minutes in TIME_BINS
+                                        ],
+                                    value=DEFAULT_TIME_BIN,
+                                    clearable=False,
+                                    style={'display': 'none'}
                                     )
                                 ]
                             ),
-                        dbc.Row(html.Div(id='visualization-1', style={'display': 'none'})),
+                        dcc.Store(id='count-cube'),
+                        dbc.Row(html.Div(dcc.Graph(id='trip-histogram'), id='visualization-1', style={'display': 'none'})),
+                        html.A('Download OD matrix (CSV)', id='od-export', href='', style={'display': 'none'}),
+                        html.Iframe(id='trip-map', src='', style={'display': 'none'}),
+                        html.Div(
+                            [
+                                dcc.RadioItems(
+                                    id='density-end',
+                                    options=[
+                                        {'label': 'Origins', 'value': 'origin'},
+                                        {'label': 'Destinations', 'value': 'destination'},
+                                        ],
+                                    value='origin',
+                                    inline=True
+                                    ),
+                                dcc.RangeSlider(
+                                    id='density-hours',
+                                    min=0, max=30, step=DEFAULT_TIME_BIN / 60, value=[0, 30],
+                                    marks={hour: f'{hour}h' for hour in range(0, 31, 3)}
+                                    ),
+                                dcc.Graph(id='density-map'),
+                                ],
+                            id='density-container',
+                            style={'display': 'none'}
+                            ),
+                        html.Div(
+                            [
+                                dcc.Dropdown(id='baseline-scenario', clearable=False, placeholder='Baseline scenario'),
+                                dcc.Dropdown(
+                                    id='comparison-dimension',
+                                    options=[{'label': name, 'value': value} for value, name in DEMOGRAPHICS.items()],
+                                    value='gender',
+                                    clearable=False
+                                    ),
+                                html.Div(id='comparison-table'),
+                                dcc.Graph(id='comparison-figure'),
+                                ],
+                            id='comparison-container',
+                            style={'display': 'none'}
+                            ),
                         dbc.Row(
                             [
                                 dbc.Col(html.Div("One of three columns")),
@@ -175,8 +246,24 @@ vc_conten_2 = html.Div(
                         },
                     id='upload-data',
                     multiple=True),
+                html.Div(
+                    [
+                        html.Button('Upload Large Files', id='chunked-upload-button', n_clicks=0),
+                        html.Span(id='chunked-upload-status'),
+                        html.Button(id='chunked-upload-done', n_clicks=0, style={'display': 'none'}),
+                        dcc.Store(id='spooled-uploads'),
+                        ]
+                    ),
                 html.Div(id='file-list'),
                 html.Button('Process Files', id='transform-button', n_clicks=0),
+                html.Button('Cancel', id='cancel-button', n_clicks=0),
+                dcc.Store(id='job-id'),
+                dcc.Store(id='preview-job'),
+                dcc.Store(id='dataset-key'),
+                dcc.Interval(id='job-interval', interval=1000, disabled=True),
+                dcc.Dropdown(id='loaded-scenarios', multi=True, placeholder='Scenarios to compare'),
+                html.Div(id='job-progress'),
+                html.Div(id='cancel-message'),
                 html.Hr(),
                 dcc.Loading(
                     id='loading',
@@ -197,10 +284,58 @@ vc_conten_2 = html.Div(
                                     value='distr',
                                     clearable=False,
                                     style={'display': 'none'}
+                                    ),
+                                dcc.Dropdown(
+                                    id='time-bin-dropdown',
+                                    options=[
+                                        {'label': f'{minutes} min', 'value': minutes} for minutes in TIME_BINS
+                                        ],
+                                    value=DEFAULT_TIME_BIN,
+                                    clearable=False,
+                                    style={'display': 'none'}
                                     )
                                 ]
                             ),
-                        dbc.Row(html.Div(id='visualization-1', style={'display': 'none'})),
+                        dcc.Store(id='count-cube'),
+                        dbc.Row(html.Div(dcc.Graph(id='trip-histogram'), id='visualization-1', style={'display': 'none'})),
+                        html.A('Download OD matrix (CSV)', id='od-export', href='', style={'display': 'none'}),
+                        html.Iframe(id='trip-map', src='', style={'display': 'none'}),
+                        html.Div(
+                            [
+                                dcc.RadioItems(
+                                    id='density-end',
+                                    options=[
+                                        {'label': 'Origins', 'value': 'origin'},
+                                        {'label': 'Destinations', 'value': 'destination'},
+                                        ],
+                                    value='origin',
+                                    inline=True
+                                    ),
+                                dcc.RangeSlider(
+                                    id='density-hours',
+                                    min=0, max=30, step=DEFAULT_TIME_BIN / 60, value=[0, 30],
+                                    marks={hour: f'{hour}h' for hour in range(0, 31, 3)}
+                                    ),
+                                dcc.Graph(id='density-map'),
+                                ],
+                            id='density-container',
+                            style={'display': 'none'}
+                            ),
+                        html.Div(
+                            [
+                                dcc.Dropdown(id='baseline-scenario', clearable=False, placeholder='Baseline scenario'),
+                                dcc.Dropdown(
+                                    id='comparison-dimension',
+                                    options=[{'label': name, 'value': value} for value, name in DEMOGRAPHICS.items()],
+                                    value='gender',
+                                    clearable=False
+                                    ),
+                                html.Div(id='comparison-table'),
+                                dcc.Graph(id='comparison-figure'),
+                                ],
+                            id='comparison-container',
+                            style={'display': 'none'}
+                            ),
                         dbc.Row(
                             [
                                 dbc.Col(html.Div("One of three columns")),
@@ -231,42 +366,237 @@ vc_conten_2 = html.Div(
 
 @app.callback(
     [
-        Output('visualization-1', 'children'),
-        Output('visualization-1', 'style'),
-        Output('color-dropdown', 'style'), 
+        Output('job-id', 'data'),
+        Output('job-interval', 'disabled'),
         Output('alert-message', 'children'),
     ],
+    [Input('transform-button', 'n_clicks')],
+    [State('upload-data', 'contents'), State('upload-data', 'filename'), State('spooled-uploads', 'data')],
+    prevent_initial_call=True
+)
+def process_uploaded_files(n_clicks, contents, filenames, spooled):
+    sources, filenames = upload_sources(contents, filenames, spooled)
+    if len(sources) == 0:
+        return None, True, html.Div('Please upload files before processing.')
+    else:
+        # Processing runs in a background job, polled by the job interval.
+        # Each file keeps its name as label, files processed before are not processed again.
+        labels = [scenario_label(filename, f'scenario_{i + 1}') for i, filename in enumerate(filenames)]
+        return submit_job(sources, labels), False, ''
+
+
+@app.callback(
     [
-        Input('transform-button', 'n_clicks'),
-        Input('color-dropdown', 'value')  # Add this line to get the dropdown value
+        Output('job-progress', 'children'),
+        Output('loaded-scenarios', 'options'),
+        Output('loaded-scenarios', 'value'),
+        Output('job-interval', 'disabled'),
+        Output('preview-job', 'data'),
     ],
-    [State('upload-data', 'contents')],
+    [Input('job-interval', 'n_intervals')],
+    [State('job-id', 'data'), State('loaded-scenarios', 'value'), State('preview-job', 'data')]
+)
+def poll_job(n_intervals, job_id, loaded, preview_job):
+    # Every stored scenario can be added to or removed from the comparison without processing it again
+    options = [
+        {'label': f"{(info['labels'] or [info['key'][:8]])[0]} ({info['rows']} trips)", 'value': info['key']}
+        for info in list_scenarios()
+    ]
+    if job_id is None:
+        return '', options, dash.no_update, True, dash.no_update
+
+    # A sampled preview is drawn once, as soon as the job has written it, and dropped when the job ends
+    status = job_status(job_id)
+    clear_preview = None if preview_job else dash.no_update
+    if status['state'] in ('queued', 'running'):
+        preview = job_id if preview_job != job_id and has_job_preview(job_id) else dash.no_update
+        return [
+            html.Div(f"Processing: {status['stage']}"),
+            dbc.Progress(value=status['progress']),
+        ], dash.no_update, dash.no_update, False, preview
+    elif status['state'] == 'done':
+        return '', options, list(dict.fromkeys((loaded or []) + load_job_result(job_id))), True, clear_preview
+    elif status['state'] == 'cancelled':
+        return html.Div('Processing cancelled.'), options, dash.no_update, True, clear_preview
+    else:
+        return html.Div(f"Processing failed: {status.get('error', 'unknown error')}"), options, dash.no_update, True, clear_preview
+
+
+@app.callback(
+    Output('dataset-key', 'data'),
+    [Input('loaded-scenarios', 'value')],
     prevent_initial_call=True
 )
-def process_uploaded_files(n_clicks, color_value, contents):
-    if contents is None or len(contents) == 0:
-        return [], {'display': 'none'}, {'display': 'none'}, html.Div('Please upload files before processing.')
+def update_dataset_key(loaded):
+    return dataset_key(loaded or [])
+
+
+@app.callback(
+    Output('cancel-message', 'children'),
+    [Input('cancel-button', 'n_clicks')],
+    [State('job-id', 'data')],
+    prevent_initial_call=True
+)
+def cancel_processing(n_clicks, job_id):
+    if job_id is not None:
+        cancel_job(job_id)
+        return html.Div('Cancelling...')
+    return ''
+
+
+@app.callback(
+    [
+        Output('count-cube', 'data'),
+        Output('visualization-1', 'style'),
+        Output('color-dropdown', 'style'),
+        Output('time-bin-dropdown', 'style'),
+    ],
+    [Input('dataset-key', 'data'), Input('preview-job', 'data')],
+    prevent_initial_call=True
+)
+def update_visualization(dataset_key, preview_job):
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    if preview_job and 'preview-job.data' in triggered:
+        # Estimated from a sample while the job runs, replaced by the exact cube when it is done
+        cube = load_job_preview(preview_job)
     else:
-        combined_data = process_files(contents)
+        # Merged from the per-scenario count cubes, adding or removing a scenario recounts nothing
+        cube = cached_histogram_cube(dataset_key) if dataset_key else None
+
+    if cube is None:
+        return None, {'display': 'none'}, {'display': 'none'}, {'display': 'none'}
+
+    # The browser redraws the figure from this cube whenever a dropdown changes
+    return [
+        cube,
+        {'display': 'block'},
+        {'display': 'block'},
+        {'display': 'block'},
+    ]
+
+
+@app.callback(
+    [Output('od-export', 'href'), Output('od-export', 'style')],
+    [Input('dataset-key', 'data'), Input('time-bin-dropdown', 'value')],
+    prevent_initial_call=True
+)
+def update_od_export(dataset_key, time_bin):
+    # Zone-to-zone trip counts per scenario, mode and time bin of the selected width
+    if not dataset_key:
+        return '', {'display': 'none'}
+    return od_export_url(dataset_key, time_bin), {'display': 'block'}
+
+
+@app.callback(
+    [Output('trip-map', 'src'), Output('trip-map', 'style')],
+    [Input('dataset-key', 'data')],
+    prevent_initial_call=True
+)
+def update_map(dataset_key):
+    # The Kepler page is built and cached by the /map route, only its url goes through the callback
+    if not dataset_key:
+        return '', {'display': 'none'}
+    return map_url(dataset_key), {'display': 'block', 'width': '100%', 'height': '650px', 'border': 'none'}
+
+
+@app.callback(
+    [Output('density-map', 'figure'), Output('density-container', 'style')],
+    [
+        Input('dataset-key', 'data'),
+        Input('density-end', 'value'),
+        Input('density-hours', 'value'),
+        Input('density-map', 'relayoutData'),
+    ],
+    prevent_initial_call=True
+)
+def update_density_map(dataset_key, end, hours, relayout_data):
+    # Rasterized on the server for the visible viewport, zooming or panning renders it again at full resolution
+    if not dataset_key:
+        return {}, {'display': 'none'}
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    bounds = None if 'dataset-key.data' in triggered else relayout_bounds(relayout_data)
+    figure = cached_density_figure(dataset_key, end, tuple(hours) if hours else None, bounds)
+    if figure is None:
+        return {}, {'display': 'none'}
+    return figure, {'display': 'block'}
+
 
-        if combined_data is not None:
-            fig = create_histogram_plot(combined_data, color_value)
-            return [
-                dcc.Graph(figure=fig),
-                {'display': 'block'},
-                {'display': 'block'},
-                ''
-            ]
-        else:
-            return [], {'display': 'none'}, {'display': 'none'}, html.Div('No file uploaded yet.')
+@app.callback(
+    Output('density-hours', 'step'),
+    [Input('time-bin-dropdown', 'value')]
+)
+def update_density_step(time_bin):
+    # The time window moves in steps of the selected time bin
+    return (time_bin or DEFAULT_TIME_BIN) / 60
+
+
+@app.callback(
+    [Output('baseline-scenario', 'options'), Output('baseline-scenario', 'value')],
+    [Input('dataset-key', 'data')],
+    [State('baseline-scenario', 'value')],
+    prevent_initial_call=True
+)
+def update_baseline_options(dataset_key, baseline):
+    # The first scenario is the baseline until another one is chosen
+    labels = dataset_labels(dataset_key) if dataset_key else []
+    if baseline not in labels:
+        baseline = labels[0] if labels else None
+    return [{'label': label, 'value': label} for label in labels], baseline
+
+
+@app.callback(
+    [
+        Output('comparison-table', 'children'),
+        Output('comparison-figure', 'figure'),
+        Output('comparison-container', 'style'),
+    ],
+    [
+        Input('dataset-key', 'data'),
+        Input('baseline-scenario', 'value'),
+        Input('comparison-dimension', 'value'),
+        Input('time-bin-dropdown', 'value'),
+    ],
+    prevent_initial_call=True
+)
+def update_comparison(dataset_key, baseline, dimension, time_bin):
+    # Metrics of every scenario are computed once per dataset, a new baseline only changes the deltas
+    metrics = cached_comparison(dataset_key) if dataset_key else None
+    if metrics is None:
+        return None, {}, {'display': 'none'}
+    if baseline not in metrics['labels']:
+        baseline = metrics['labels'][0]
+    table = dbc.Table.from_dataframe(summary_table(metrics, baseline), striped=True, bordered=True, hover=True, size='sm')
+    if len(metrics['labels']) < 2:
+        return table, {}, {'display': 'block'}
+    return table, comparison_figure(metrics, baseline, dimension, time_bin or DEFAULT_TIME_BIN), {'display': 'block'}
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='cube', function_name='histogram'),
+    Output('trip-histogram', 'figure'),
+    [
+        Input('count-cube', 'data'),
+        Input('color-dropdown', 'value'),
+        Input('time-bin-dropdown', 'value'),
+    ],
+)
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='uploads', function_name='completed'),
+    Output('spooled-uploads', 'data'),
+    [Input('chunked-upload-done', 'n_clicks')],
+    prevent_initial_call=True
+)
 
 
 @app.callback(
     Output('file-list', 'children'),
-    [Input('upload-data', 'filename')],
+    [Input('upload-data', 'filename'), Input('spooled-uploads', 'data')],
     prevent_initial_call=True
 )
-def update_file_list(filenames):
+def update_file_list(filenames, spooled):
+    filenames = list(filenames or []) + [upload['filename'] for upload in spooled or []]
     if filenames:
         return html.Ul([
             html.Li(filename) for filename in filenames
@@ -0,0 +1,76 @@
+/* Draws the trip histogram in the browser from the count cube and base
+   figure built by cache.cached_histogram_cube and visualization.cube_view,
+   so switching the color or time bin dropdown never goes back to the
+   server. */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    cube: {
+        histogram: function (cube, colorValue, timeBin) {
+            if (!cube) {
+                return window.dash_clientside.no_update;
+            }
+            var dimension = cube.dimensions[colorValue] || cube.dimensions.distr;
+            var width = (timeBin || cube.time_bin) * 60;
+            var colors = cube.colors;
+            var traces = [];
+
+            // Re-bin the finest counts into the selected bin width
+            var sums = {};
+            for (var i = 0; i < dimension.count.length; i++) {
+                var bin = Math.floor(dimension.time[i] / width) * width;
+                var key = dimension.label[i] + '|' + dimension.group[i];
+                sums[key] = sums[key] || {};
+                sums[key][bin] = (sums[key][bin] || 0) + dimension.count[i];
+            }
+
+            cube.labels.forEach(function (label, l) {
+                var axes = cube.axes[l];
+                dimension.groups.forEach(function (group, g) {
+                    var bins = sums[l + '|' + g];
+                    if (!bins) {
+                        return;
+                    }
+                    var x = Object.keys(bins).map(Number).sort(function (a, b) { return a - b; });
+                    traces.push({
+                        type: 'bar',
+                        x: x.map(function (seconds) { return seconds / 3600; }),
+                        y: x.map(function (seconds) { return bins[seconds]; }),
+                        width: width / 3600,
+                        offset: 0,
+                        name: group,
+                        legendgroup: group,
+                        showlegend: l === 0,
+                        marker: {color: colors[g % colors.length]},
+                        xaxis: axes.bar[0],
+                        yaxis: axes.bar[1]
+                    });
+                });
+            });
+
+            var boxes = dimension.boxes;
+            for (var b = 0; b < boxes.label.length; b++) {
+                var group = dimension.groups[boxes.group[b]];
+                var axes = cube.axes[boxes.label[b]];
+                var hours = function (stat) { return [boxes[stat][b] / 3600]; };
+                traces.push({
+                    type: 'box',
+                    orientation: 'h',
+                    y: [group],
+                    q1: hours('q1'),
+                    median: hours('median'),
+                    q3: hours('q3'),
+                    lowerfence: hours('lowerfence'),
+                    upperfence: hours('upperfence'),
+                    mean: hours('mean'),
+                    name: group,
+                    legendgroup: group,
+                    showlegend: false,
+                    marker: {color: colors[boxes.group[b] % colors.length]},
+                    xaxis: axes.box[0],
+                    yaxis: axes.box[1]
+                });
+            }
+
+            return {data: traces, layout: cube.layout};
+        }
+    }
+});
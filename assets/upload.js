@@ -0,0 +1,135 @@
+/* Streams large subtrip files to the server in chunks instead of base64
+   encoding them into dcc.Upload contents. Interrupted uploads resume from
+   the size the server reports. Network errors are retried a few times with
+   backoff, other failures are shown in the upload status. When every file
+   is done, the hidden 'chunked-upload-done' button is clicked so the Dash
+   store picks up the upload ids. */
+(function () {
+    var CHUNK_BYTES = 8 * 1024 * 1024;
+    // Network errors are retried this many times in a row, waiting twice as long each time
+    var MAX_RETRIES = 6;
+    var RETRY_MS = 1000;
+    window.chunkedUploads = [];
+
+    function uploadId(file) {
+        var random = Math.random().toString(16).slice(2, 10);
+        return (Date.now().toString(16) + '-' + random + '-' + file.size.toString(16));
+    }
+
+    function setStatus(text) {
+        var status = document.getElementById('chunked-upload-status');
+        if (status) {
+            status.textContent = text;
+        }
+    }
+
+    function wait(ms) {
+        return new Promise(function (resolve) {
+            setTimeout(resolve, ms);
+        });
+    }
+
+    function checked(response) {
+        // 409 answers a chunk sent at the wrong offset with the size to resume from, other error
+        // statuses (invalid upload, full spool) are final and are not retried
+        if (response.ok || response.status === 409) {
+            return response.json();
+        }
+        return response.json().catch(function () {
+            return {};
+        }).then(function (result) {
+            var error = new Error(result.error || response.status + ' ' + response.statusText);
+            error.final = true;
+            throw error;
+        });
+    }
+
+    function sendFile(file) {
+        var id = uploadId(file);
+
+        function resume(error, attempt) {
+            // Network error: wait, then ask the server how far it got and carry on from there
+            if (error.final || attempt >= MAX_RETRIES) {
+                throw error;
+            }
+            setStatus(file.name + ': connection lost, retrying');
+            return wait(RETRY_MS * Math.pow(2, attempt)).then(function () {
+                return fetch('/upload/' + id).then(checked);
+            }).then(function (result) {
+                return send(result.size, attempt + 1);
+            }, function (error) {
+                return resume(error, attempt + 1);
+            });
+        }
+
+        function send(offset, attempt) {
+            if (offset >= file.size) {
+                return fetch('/upload/' + id + '/complete', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({filename: file.name})
+                }).then(checked).then(function () {
+                    return {id: id, filename: file.name};
+                }, function (error) {
+                    return resume(error, attempt);
+                });
+            }
+            setStatus(file.name + ': ' + Math.round(100 * offset / file.size) + '%');
+            return fetch('/upload/' + id + '/chunk?offset=' + offset, {
+                method: 'POST',
+                body: file.slice(offset, offset + CHUNK_BYTES)
+            }).then(checked).then(function (result) {
+                return send(result.size, 0);
+            }, function (error) {
+                return resume(error, attempt);
+            });
+        }
+
+        return send(0, 0).catch(function (error) {
+            throw new Error(file.name + ': ' + error.message);
+        });
+    }
+
+    function uploadFiles(fileList) {
+        var files = Array.prototype.slice.call(fileList);
+        var uploads = [];
+        files.reduce(function (previous, file) {
+            return previous.then(function () {
+                return sendFile(file).then(function (upload) {
+                    uploads.push(upload);
+                });
+            });
+        }, Promise.resolve()).then(function () {
+            setStatus('');
+        }, function (error) {
+            // Files uploaded before the failure can still be processed
+            setStatus('Upload failed, ' + error.message);
+        }).then(function () {
+            window.chunkedUploads = uploads;
+            document.getElementById('chunked-upload-done').click();
+        });
+    }
+
+    // Dash has no file input component, so the button opens one created here
+    document.addEventListener('click', function (event) {
+        if (!event.target.closest || !event.target.closest('#chunked-upload-button')) {
+            return;
+        }
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.multiple = true;
+        input.accept = '.csv';
+        input.addEventListener('change', function () {
+            uploadFiles(input.files);
+        });
+        input.click();
+    });
+})();
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    uploads: {
+        completed: function () {
+            return window.chunkedUploads;
+        }
+    }
+});
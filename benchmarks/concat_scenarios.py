@@ -0,0 +1,77 @@
+"""
+Compare the old append-per-file ingest with collect-then-concatenate for 2, 10
+and 50 scenario files.
+
+Run from the repository root:
+
+    python benchmarks/concat_scenarios.py --rows 20000
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_processing import HEADERS, combine_scenarios, read_scenario
+
+
+def synthetic_content(rows, seed):
+    # Base64 data URL shaped like a dcc.Upload payload
+    rng = np.random.default_rng(seed)
+    start = rng.integers(0, 24 * 3600 - 3600, rows)
+    clock = lambda seconds: pd.to_datetime(seconds, unit='s').strftime('%H:%M:%S')
+    df = pd.DataFrame({name: '0' for name in HEADERS}, index=range(rows))
+    df['person_id'] = [f'{p}-1' for p in rng.integers(1, 10000, rows)]
+    df['mode'] = rng.choice(['Car', 'BusTravel', 'Walk', 'MRT'], rows)
+    df['start_time'] = clock(start)
+    df['end_time'] = clock(start + 600)
+    df['cbd_exit_time'] = '00:00:00'
+    df['cbd_travel_time'] = '00:00:00'
+    for column in ['travel_time', 'total_distance', 'non_cbd_travel_time', 'cbd_distance', 'non_cbd_distance', 'extra']:
+        df[column] = rng.random(rows)
+    return 'data:text/csv;base64,' + base64.b64encode(df.to_csv(index=False).encode()).decode()
+
+
+def append_per_file(frames):
+    # Equivalent of the former DataFrame.append loop
+    combined = pd.DataFrame()
+    for df in frames:
+        combined = pd.concat([combined, df])
+    return combined
+
+
+def measure(strategy, frames):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = strategy(frames)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000, help='rows per scenario file')
+    parser.add_argument('--scenarios', type=int, nargs='+', default=[2, 10, 50])
+    args = parser.parse_args()
+
+    content = synthetic_content(args.rows, seed=0)
+    frame = read_scenario(content, 'scenario_1')
+
+    print(f"{'files':>6} {'rows':>10} {'strategy':>18} {'seconds':>9} {'peak MB':>9}")
+    for count in args.scenarios:
+        frames = [frame.assign(label=f'scenario_{i + 1}') for i in range(count)]
+        for name, strategy in [('append per file', append_per_file), ('concat once', combine_scenarios)]:
+            elapsed, peak, rows = measure(strategy, frames)
+            print(f'{count:>6} {rows:>10} {name:>18} {elapsed:>9.3f} {peak / 1e6:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure how long a fresh interpreter takes to import the app and check it
+against a budget, listing the packages that cost the most.
+
+Run from the repository root:
+
+    python benchmarks/import_time.py --budget 2.5
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy packages the web workers should not import until they are needed
+LAZY_MODULES = ['geopandas', 'shapely', 'keplergl', 'plotly.express']
+
+
+def import_times(module, runs):
+    # Best wall time of several fresh interpreters, and the -X importtime cumulative seconds of each direct import
+    code = (
+        'import sys, time; started = time.perf_counter(); import {0}; '
+        'print(time.perf_counter() - started); print(",".join(m for m in {1} if m in sys.modules))'
+    ).format(module, LAZY_MODULES)
+    seconds, loaded = [], ''
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        wall, loaded = output.splitlines()[-2:] if output.count('\n') >= 2 else (output.strip(), '')
+        seconds.append(float(wall))
+
+    trace = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                           cwd=ROOT, capture_output=True, text=True, check=True).stderr
+    packages = {}
+    for line in trace.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Modules imported directly by the measured one are indented by one level
+        if name.startswith('   ') and not name.startswith('     '):
+            packages[name.strip()] = int(cumulative) / 1e6
+    return min(seconds), [name for name in loaded.split(',') if name], packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--budget', type=float, default=2.5, help='seconds allowed to import the module')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    seconds, loaded, packages = import_times(args.module, args.runs)
+    for name, cumulative in sorted(packages.items(), key=lambda item: -item[1])[:10]:
+        print(f'{name:>30} {cumulative:>7.3f} s')
+    print(f'\nimport {args.module}: {seconds:.3f} s (budget {args.budget:.3f} s)')
+    if loaded:
+        print('imported eagerly although only needed later: ' + ', '.join(loaded))
+    sys.exit(0 if seconds <= args.budget and not loaded else 1)
+
+
+if __name__ == '__main__':
+    main()
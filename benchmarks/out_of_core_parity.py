@@ -0,0 +1,100 @@
+"""
+Check that the out-of-core engine stores the same trip table and count cube
+as the in-memory pandas path, and compare their time and peak memory.
+
+Run from the repository root with one or more subtrip files:
+
+    python benchmarks/out_of_core_parity.py path/to/subtrip_metrics.csv --chunk-rows 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scenario_store
+from aggregation import COLOR_DIMENSIONS, count_cube
+from data_processing import CATEGORICAL_COLUMNS, process_files, scenario_label
+from out_of_core import process_out_of_core
+
+
+def measure(function, *args, **kwargs):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def frame_differences(expected, actual):
+    # Column names, row count and values, categoricals compared by value since their category order may differ
+    if list(expected.columns) != list(actual.columns):
+        return [f'columns {list(expected.columns)} != {list(actual.columns)}']
+    if len(expected) != len(actual):
+        return [f'{len(expected)} rows != {len(actual)} rows']
+    differences = []
+    for column in expected.columns:
+        left, right = expected[column], actual[column]
+        if column in CATEGORICAL_COLUMNS:
+            left, right = left.astype(str), right.astype(str)
+        if not np.array_equal(left.to_numpy(), right.to_numpy()):
+            differences.append(f'values of {column}')
+    return differences
+
+
+def cube_differences(expected, actual, tolerance=0.11):
+    # Counts must match exactly, box statistics up to the rounding to one decimal
+    differences = [] if expected['labels'] == actual['labels'] else ['labels']
+    for dimension in COLOR_DIMENSIONS:
+        left, right = expected['dimensions'][dimension], actual['dimensions'][dimension]
+        for key in ['groups', 'label', 'time', 'group', 'count']:
+            if left[key] != right[key]:
+                differences.append(f'{dimension} {key}')
+        for stat, values in left['boxes'].items():
+            if not np.allclose(values, right['boxes'][stat], atol=tolerance):
+                differences.append(f'{dimension} box {stat}')
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='+', help='subtrip csv files')
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    # Write the out-of-core results to a scratch store, not the app's
+    scenario_store.STORE_DIR = tempfile.mkdtemp(prefix='out_of_core_parity_')
+
+    failed = False
+    print(f"{'file':>30} {'engine':>12} {'seconds':>9} {'peak MB':>9}")
+    for i, path in enumerate(args.files):
+        label = scenario_label(path, f'scenario_{i + 1}')
+        expected, elapsed, peak = measure(process_files, [path], compact=True, labels=[label])
+        print(f'{label:>30} {"pandas":>12} {elapsed:>9.3f} {peak / 1e6:>9.1f}')
+        expected_cube = count_cube(expected)
+
+        key = f'parity-{i}'
+        _, elapsed, peak = measure(process_out_of_core, key, path, label, chunk_rows=args.chunk_rows)
+        print(f'{label:>30} {"out of core":>12} {elapsed:>9.3f} {peak / 1e6:>9.1f}')
+
+        differences = (
+            frame_differences(expected, scenario_store.open_scenario(key))
+            + cube_differences(expected_cube, scenario_store.open_cube(key))
+        )
+        for difference in differences:
+            print(f'{label:>30} differs: {difference}')
+        failed = failed or bool(differences)
+
+    print('outputs differ' if failed else 'outputs match')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Time every stage of process_files, the histogram figures and their JSON size
+on synthetic workloads, and compare the results with an earlier run.
+
+Run from the repository root:
+
+    python benchmarks/pipeline.py --rows 10000 100000 --scenarios 1 5 --save benchmarks/results/baseline.json
+    python benchmarks/pipeline.py --rows 10000 100000 --scenarios 1 5 --compare benchmarks/results/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import workload
+from aggregation import count_cube
+from data_processing import (
+    attach_node_coordinates, attach_person_attributes, combine_scenarios, compact_trip_table, enrich_trips,
+    read_scenarios,
+)
+from reference_data import get_reference_data
+from visualization import create_histogram_plot, cube_view, stacked_histogram
+
+# A stage this much slower than in the compared run is reported as a regression
+REGRESSION_RATIO = 1.2
+
+
+def measure(function, repeat):
+    # Median time over the repeats and the peak of traced allocations of the last one
+    times = []
+    for i in range(repeat):
+        if i == repeat - 1:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - started)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': float(np.median(times)), 'peak_mb': peak / 1e6}
+
+
+def json_size(value):
+    return len(json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def run_workload(paths, repeat):
+    labels = [f'scenario_{i + 1}' for i in range(len(paths))]
+    reference, stages = measure(get_reference_data, 1)
+    results = {'reference': stages}
+
+    frames, results['parse'] = measure(lambda: read_scenarios(paths, labels), repeat)
+    combined, results['combine'] = measure(lambda: combine_scenarios(frames), repeat)
+    persons, results['enrich'] = measure(lambda: attach_person_attributes(combined, reference.person_table), repeat)
+    _, results['geo-join'] = measure(
+        lambda: attach_node_coordinates(persons, reference.node_index, reference.zone_index), repeat)
+    trips, results['enrich_trips'] = measure(lambda: enrich_trips(combined, reference), repeat)
+    compact, results['compact'] = measure(lambda: compact_trip_table(trips), repeat)
+
+    cube, results['count_cube'] = measure(lambda: count_cube(compact), repeat)
+    view, results['cube_view'] = measure(lambda: cube_view(cube), repeat)
+    histogram, results['create_histogram_plot'] = measure(lambda: create_histogram_plot(trips, 'mode'), repeat)
+    stacked, results['stacked_histogram'] = measure(lambda: stacked_histogram(trips, 'mode'), repeat)
+    _, results['histogram_to_json'] = measure(histogram.to_json, repeat)
+
+    sizes = {
+        'trips': len(compact),
+        'trip_table_mb': compact.memory_usage(deep=True).sum() / 1e6,
+        'cube_json_bytes': json_size(view),
+        'histogram_json_bytes': json_size(histogram.to_plotly_json()),
+        'stacked_json_bytes': json_size(stacked.to_plotly_json()),
+    }
+    return results, sizes
+
+
+def compare(current, baseline):
+    # Stage times relative to the baseline run of the same workload
+    previous = {(run['rows'], run['scenarios']): run for run in baseline['runs']}
+    regressions = 0
+    for run in current['runs']:
+        before = previous.get((run['rows'], run['scenarios']))
+        if before is None:
+            continue
+        for stage, result in run['stages'].items():
+            if stage not in before['stages']:
+                continue
+            ratio = result['seconds'] / max(before['stages'][stage]['seconds'], 1e-9)
+            flag = ' REGRESSION' if ratio > REGRESSION_RATIO else ''
+            regressions += bool(flag)
+            print(f"{run['rows']:>10} {run['scenarios']:>4} {stage:>22} {before['stages'][stage]['seconds']:>9.3f} "
+                  f"{result['seconds']:>9.3f} {ratio:>6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='rows per scenario file')
+    parser.add_argument('--scenarios', type=int, nargs='+', default=[1, 5], help='numbers of scenario files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workloads', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workloads'))
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    workload.prepare_reference_data(os.path.join(args.workloads, 'data'))
+    current = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'runs': [],
+    }
+    print(f"{'rows':>10} {'files':>5} {'stage':>22} {'seconds':>9} {'peak MB':>9}")
+    for rows in args.rows:
+        for scenarios in args.scenarios:
+            paths = workload.generate(args.workloads, rows, scenarios)
+            stages, sizes = run_workload(paths, args.repeat)
+            current['runs'].append({'rows': rows, 'scenarios': scenarios, 'stages': stages, 'sizes': sizes})
+            for stage, result in stages.items():
+                print(f"{rows:>10} {scenarios:>5} {stage:>22} {result['seconds']:>9.3f} {result['peak_mb']:>9.1f}")
+            print(f"{rows:>10} {scenarios:>5} {'sizes':>22} " + ', '.join(f'{name}={value:g}' for name, value in sizes.items()))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\n{'rows':>10} {'files':>4} {'stage':>22} {'before':>9} {'after':>9} {'ratio':>7}")
+        sys.exit(1 if compare(current, baseline) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Deterministic synthetic SimMobility subtrip files for benchmarks.
+
+Rows use the 23 columns of data_processing.HEADERS, node ids from node.shp and
+person ids from the population table, so every stage of process_files does
+real work. Without a population table (it is not part of the repository) a
+synthetic one is written next to a copy of the reference data.
+
+Run from the repository root:
+
+    python benchmarks/workload.py --rows 1000000 --scenarios 3 --out benchmarks/workloads
+"""
+import argparse
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reference_data
+from data_processing import HEADERS
+
+MODES = ['Car', 'BusTravel', 'MRT', 'Walk', 'Taxi', 'Motorcycle']
+MODE_SHARES = [0.3, 0.25, 0.2, 0.15, 0.06, 0.04]
+CHUNK_ROWS = 1000000
+
+# Every 'HH:MM:SS' from 00:00:00 to 29:59:59, indexed by seconds, so times are looked up instead of formatted
+CLOCK = np.array([f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in range(30 * 3600)])
+
+
+def node_ids():
+    import geopandas as gpd
+    return np.sort(pd.to_numeric(gpd.read_file(reference_data.reference_path('nodes'))['id']).to_numpy(np.int64))
+
+
+def person_ids():
+    return np.sort(pd.read_csv(reference_data.reference_path('population'), usecols=['id'])['id'].to_numpy(np.int64))
+
+
+def synthetic_population(persons, seed=0):
+    # Population table whose codes all exist in the category tables, incomes spread over every range
+    rng = np.random.default_rng(seed)
+    codes = {
+        name: pd.read_csv(reference_data.reference_path(name))['id'].to_numpy()
+        for name in ['gender', 'education', 'vehicle', 'age']
+    }
+    flags = lambda: rng.choice(['t', 'f'], persons)
+    return pd.DataFrame({
+        'id': np.arange(1, persons + 1),
+        'gender_id': rng.choice(codes['gender'], persons),
+        'education_type_id': rng.choice(codes['education'], persons),
+        'vehicle_category_id': rng.choice(codes['vehicle'], persons),
+        'age_category_id': rng.choice(codes['age'], persons),
+        'income': rng.integers(0, 12000, persons).astype(float),
+        'work_at_home': flags(),
+        'car_license': flags(),
+        'motor_license': flags(),
+        'vanbus_license': flags(),
+        'fixed_workplace': flags(),
+        'is_student': flags(),
+    })
+
+
+def prepare_reference_data(data_dir, persons=100000, seed=0):
+    # Use the reference data as is when it has a population table, otherwise a copy with a synthetic one
+    if os.path.exists(reference_data.reference_path('population')):
+        return reference_data.DATA_DIR
+    if not os.path.exists(os.path.join(data_dir, reference_data.REFERENCE_FILES['population'])):
+        shutil.copytree(reference_data.DATA_DIR, data_dir, dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns('scenarios'))
+        synthetic_population(persons, seed).to_csv(os.path.join(data_dir, reference_data.REFERENCE_FILES['population']), index=False)
+    reference_data.DATA_DIR = data_dir
+    return data_dir
+
+
+def subtrip_frame(rows, nodes, persons, seed, first_trip=0):
+    # One chunk of subtrips; trips start around the morning and evening peaks and some past midnight
+    rng = np.random.default_rng(seed)
+    person = rng.choice(persons, rows)
+    trip = np.arange(first_trip, first_trip + rows)
+    peaks = rng.choice([8.5 * 3600, 13 * 3600, 18 * 3600], rows, p=[0.45, 0.2, 0.35])
+    start = np.clip(rng.normal(peaks, 2.5 * 3600), 0, 26 * 3600).astype(np.int64)
+    travel = rng.gamma(2.0, 900, rows).astype(np.int64) + 60
+    end = np.minimum(start + travel, len(CLOCK) - 1)
+    distance = travel / 3600 * rng.uniform(4, 40, rows)
+    person_text = person.astype(str)
+    trip_text = np.char.add(np.char.add(person_text, '-'), trip.astype(str))
+
+    columns = {
+        'person_id': np.char.add(person_text, '-1'),
+        'trip_id': trip_text,
+        'subtrip_id': np.char.add(trip_text, '-1'),
+        'origin_type': 'NODE',
+        'origin_node': rng.choice(nodes, rows),
+        'origin_taz': 0,
+        'destination_type': 'NODE',
+        'destination_node': rng.choice(nodes, rows),
+        'destination_taz': 0,
+        'mode': rng.choice(MODES, rows, p=MODE_SHARES),
+        'start_time': CLOCK[start],
+        'end_time': CLOCK[end],
+        'travel_time': travel / 3600,
+        'total_distance': distance,
+        'cbd_entry_node': 0,
+        'cbd_exit_node': 0,
+        'cbd_entry_time': '00:00:00',
+        'cbd_exit_time': '00:00:00',
+        'cbd_travel_time': '00:00:00',
+        'non_cbd_travel_time': travel / 3600,
+        'cbd_distance': 0.0,
+        'non_cbd_distance': distance,
+        'extra': 0.0,
+    }
+    return pd.DataFrame(columns, columns=HEADERS)
+
+
+def write_scenario(path, rows, seed, nodes=None, persons=None, chunk_rows=CHUNK_ROWS):
+    # Written chunk by chunk so 20M-row files need no more memory than 1M-row ones
+    nodes = node_ids() if nodes is None else nodes
+    persons = person_ids() if persons is None else persons
+    with open(path, 'w', newline='') as f:
+        for i, first in enumerate(range(0, rows, chunk_rows)):
+            chunk = subtrip_frame(min(chunk_rows, rows - first), nodes, persons, seed * 100003 + i, first)
+            chunk.to_csv(f, index=False, header=i == 0)
+    return path
+
+
+def generate(out, rows, scenarios, seed=0):
+    # Scenario files are reused when they already exist with the same size and seed in their name
+    os.makedirs(out, exist_ok=True)
+    nodes, persons = node_ids(), person_ids()
+    paths = []
+    for i in range(scenarios):
+        path = os.path.join(out, f'subtrips_{rows}_{seed + i}.csv')
+        if not os.path.exists(path):
+            write_scenario(path + '.tmp', rows, seed + i, nodes, persons)
+            os.replace(path + '.tmp', path)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000, help='rows per scenario file (10k to 20M)')
+    parser.add_argument('--scenarios', type=int, default=1, help='number of scenario files (1 to 50)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workloads'))
+    parser.add_argument('--persons', type=int, default=100000, help='size of the synthetic population, when one is needed')
+    args = parser.parse_args()
+
+    prepare_reference_data(os.path.join(args.out, 'data'), args.persons, args.seed)
+    for path in generate(args.out, args.rows, args.scenarios, args.seed):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
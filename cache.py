@@ -0,0 +1,270 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+import plotly
+
+from aggregation import count_cube, merge_cubes
+from cache_backends import CACHE_BACKEND, frame_bytes, make_cache
+from comparison import METRIC_COLUMNS, combine_metrics, metrics_bytes, scenario_metrics
+from data_processing import DEFAULT_TIME_BIN, TRIP_COLUMNS, no_progress, process_files
+from maps import (
+    KEPLER_CONFIG, MAP_PARTS, config_key, dataset_map, filter_values, map_columns, map_html, map_parts, select_columns,
+)
+from metrics import record_payload
+from od_matrix import od_counts, sum_od
+from out_of_core import process_out_of_core, use_out_of_core
+from rasters import RASTER_PIXELS, density_figure, density_grid, full_bounds, raster_shape
+from reference_data import get_reference_data, reference_version
+from scenario_store import (
+    has_scenario, open_cube, open_scenario, open_table, save_cube, save_scenario, save_table, scenario_batches,
+    scenario_info,
+)
+from uploads import file_digest
+from visualization import cube_view
+
+
+def partition_key(content):
+    # Hash of one uploaded file (data URL or spooled path) plus the reference-data version and trip columns
+    digest = hashlib.sha1()
+    digest.update(reference_version().encode())
+    # Scenarios stored with other columns are processed again
+    digest.update(','.join(TRIP_COLUMNS).encode())
+    if content.startswith('data:'):
+        digest.update(hashlib.sha1(content.encode()).digest())
+    else:
+        digest.update(file_digest(content).encode())
+    return digest.hexdigest()
+
+
+# A dataset is a set of scenario partitions, its key lists their keys
+def dataset_key(partition_keys):
+    return '+'.join(partition_keys) if partition_keys else None
+
+
+def partition_keys(key):
+    return key.split('+') if key else []
+
+
+# Memory by default, CACHE_BACKEND=disk or redis shares the cache between gunicorn workers
+dataset_cache = make_cache()
+
+
+def get_partition(key):
+    # One processed scenario, from memory or the scenario store
+    df = dataset_cache.get(key)
+    if df is None and has_scenario(key):
+        df = open_scenario(key)
+    return df
+
+
+def dataset_labels(key):
+    # Facet label of each partition, two files with the same name still get their own facet
+    labels = []
+    for partition in partition_keys(key):
+        info = scenario_info(partition)
+        label = info['labels'][0] if info and info['labels'] else partition[:8]
+        while label in labels:
+            label += "'"
+        labels.append(label)
+    return labels
+
+
+def has_partition(key):
+    return key in dataset_cache or has_scenario(key)
+
+
+def cached_partition(content, label, progress=no_progress):
+    # Process one uploaded file unless it is already cached or stored, returning its partition key
+    key = partition_key(content)
+    if has_partition(key):
+        return key
+    if use_out_of_core(content):
+        # Larger than a worker should hold, written to the store and counted chunk by chunk
+        process_out_of_core(key, content, label, progress=progress)
+        # Map parts too, the map page could otherwise only build them by scanning the whole file again
+        partition_map_parts(key)
+    else:
+        # Compact frames let more scenarios fit before eviction
+        df = process_files([content], compact=True, progress=progress, labels=[label])
+        save_scenario(key, df, [label])
+        # Partitions are processed in job workers, whose memory cache no web worker reads: the store is enough there
+        if CACHE_BACKEND != 'memory':
+            dataset_cache.put(key, df)
+    return key
+
+
+def partition_cube(key):
+    # Counts of a single scenario, computed once and reused by every dataset that contains it
+    cube_key = f'{key}:counts'
+    cube = dataset_cache.get(cube_key) or open_cube(key)
+    if cube is None:
+        df = get_partition(key)
+        if df is None:
+            return None
+        cube = json.loads(json.dumps(count_cube(df), cls=plotly.utils.PlotlyJSONEncoder))
+        if has_scenario(key):
+            save_cube(key, cube)
+    dataset_cache.put(cube_key, cube, nbytes=len(json.dumps(cube)))
+    return cube
+
+
+def cached_histogram_cube(key):
+    # Count cube shipped to the browser for clientside recoloring, merged from the partition cubes
+    cube_key = f'{key}:cube'
+    cube = dataset_cache.get(cube_key)
+    if cube is None:
+        partitions = partition_keys(key)
+        cubes = [partition_cube(partition) for partition in partitions]
+        if not cubes or any(partition is None for partition in cubes):
+            return None
+        text = json.dumps(cube_view(merge_cubes(cubes, dataset_labels(key))), cls=plotly.utils.PlotlyJSONEncoder)
+        cube = json.loads(text)
+        record_payload('cube_view', len(text))
+        dataset_cache.put(cube_key, cube, nbytes=len(text))
+    return cube
+
+
+def partition_od(key):
+    # OD counts of a single scenario at the finest time bin, reused by every dataset that contains it
+    od_key = f'{key}:od'
+    od = dataset_cache.get(od_key)
+    if od is None:
+        od = open_table(key, 'od')
+    if od is None:
+        df = get_partition(key)
+        if df is None:
+            return None
+        od = od_counts(df)
+        if has_scenario(key):
+            save_table(key, 'od', od)
+    dataset_cache.put(od_key, od)
+    return od
+
+
+def cached_od(key, time_bin=DEFAULT_TIME_BIN):
+    # Sparse OD counts of a dataset per label x mode x time bin, under the dataset's facet labels
+    od_key = f'{key}:od:{time_bin}'
+    od = dataset_cache.get(od_key)
+    if od is None:
+        ods = [partition_od(partition) for partition in partition_keys(key)]
+        if not ods or any(partition is None for partition in ods):
+            return None
+        labels = dataset_labels(key)
+        od = sum_od([
+            partition.assign(label=pd.Categorical.from_codes(np.full(len(partition), i, dtype=np.int8), categories=labels))
+            for i, partition in enumerate(ods)
+        ], time_bin)
+        dataset_cache.put(od_key, od)
+    return od
+
+
+def partition_map_parts(key, config=KEPLER_CONFIG):
+    # Map parts of a single scenario (see maps.map_parts), folded over its stored record batches with only the
+    # columns the map needs, so a scenario processed out of core is never read whole. Stored next to its cube.
+    tables = {name: f'map-{config_key(config)[:16]}-{name}' for name in MAP_PARTS}
+    parts_key = f'{key}:map:{config_key(config)}'
+    parts = dataset_cache.get(parts_key)
+    if parts is None:
+        parts = {name: open_table(key, table) for name, table in tables.items()}
+        if any(table is None for table in parts.values()):
+            parts = None
+    if parts is None:
+        df = dataset_cache.get(key)
+        if df is None and not has_scenario(key):
+            return None
+
+        def batches(columns):
+            if df is not None:
+                return [df[[column for column in columns if column in df]]]
+            return scenario_batches(key, columns)
+
+        # The label filter is applied to the facet labels of a dataset, the others to every trip
+        loaded = filter_values(batches(select_columns(config, skip=('label',))))
+        parts = map_parts(batches(map_columns(config)), get_reference_data(), config, loaded, skip=('label',))
+        if has_scenario(key):
+            for name, table in tables.items():
+                save_table(key, table, parts[name])
+    dataset_cache.put(parts_key, parts, nbytes=sum(frame_bytes(table) for table in parts.values()))
+    return parts
+
+
+def cached_map_html(key, config=KEPLER_CONFIG):
+    # Kepler map of a dataset with sampled trips and aggregated flows, built once per dataset and config
+    # from the map parts of its scenarios
+    map_key = f'{key}:map:{config_key(config)}'
+    html = dataset_cache.get(map_key)
+    if html is None:
+        parts = [partition_map_parts(partition, config) for partition in partition_keys(key)]
+        if not parts or any(partition is None for partition in parts):
+            return None
+        html = map_html(dataset_map(parts, dataset_labels(key), get_reference_data(), config), config)
+        dataset_cache.put(map_key, html, nbytes=len(html))
+    return html
+
+
+def trip_ends(key, end):
+    # Coordinates and start times of one scenario's trip ends, only these columns are read from the store
+    columns = [f'{end}_lat', f'{end}_long', 'start_time']
+    df = dataset_cache.get(key)
+    if df is None:
+        df = open_scenario(key, columns)
+    if df is None:
+        return None
+    return [df[column].to_numpy() for column in columns]
+
+
+def cached_density_figure(key, end='origin', hours=None, bounds=None, pixels=RASTER_PIXELS):
+    # Origin or destination density of every scenario rendered server-side at viewport resolution,
+    # so the figure sent to the browser has the same size for any number of trips
+    bounds = tuple(round(value, 5) for value in bounds or full_bounds(get_reference_data().node_index))
+    figure_key = f'{key}:density:{end}:{hours}:{bounds}:{pixels}'
+    figure = dataset_cache.get(figure_key)
+    if figure is None:
+        shape = raster_shape(bounds, pixels)
+        grids = []
+        for partition in partition_keys(key):
+            ends = trip_ends(partition, end)
+            if ends is None:
+                return None
+            lat, lon, start_time = ends
+            if hours is not None:
+                during = (start_time >= hours[0] * 3600) & (start_time < hours[1] * 3600)
+                lat, lon = lat[during], lon[during]
+            grids.append(density_grid(lat, lon, bounds, shape))
+        figure = density_figure(grids, dataset_labels(key), bounds, f'Trip {end}s').to_plotly_json()
+        text = json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)
+        figure = json.loads(text)
+        record_payload('density_figure', len(text))
+        dataset_cache.put(figure_key, figure, nbytes=len(text))
+    return figure
+
+
+def partition_metrics(key):
+    # Comparison metrics of a single scenario, only the columns they need are read from the store
+    metrics_key = f'{key}:metrics'
+    metrics = dataset_cache.get(metrics_key)
+    if metrics is None:
+        df = dataset_cache.get(key)
+        if df is None:
+            df = open_scenario(key, METRIC_COLUMNS)
+        if df is None:
+            return None
+        metrics = scenario_metrics(df)
+        dataset_cache.put(metrics_key, metrics, nbytes=metrics_bytes(metrics))
+    return metrics
+
+
+def cached_comparison(key):
+    # Comparison metrics of a dataset under its facet labels. Choosing another baseline only changes
+    # the deltas drawn from these tables, and adding a scenario computes the metrics of that one only.
+    comparison_key = f'{key}:comparison'
+    metrics = dataset_cache.get(comparison_key)
+    if metrics is None:
+        parts = [partition_metrics(partition) for partition in partition_keys(key)]
+        if not parts or any(part is None for part in parts):
+            return None
+        metrics = combine_metrics(parts, dataset_labels(key))
+        dataset_cache.put(comparison_key, metrics, nbytes=metrics_bytes(metrics))
+    return metrics
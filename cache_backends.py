@@ -0,0 +1,252 @@
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from scenario_store import read_arrow, replacing, write_arrow
+
+# Backend and limits of the processed-dataset cache
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dash_mobility_cache'))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+MAX_ENTRIES = 8
+MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def plain_json(value):
+    # JSON text of a value made of plain lists, dicts, strings and numbers, None for anything else
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class DatasetCache:
+    # LRU cache of processed DataFrames, evicting on entry count and total size
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, df, nbytes=None):
+        size = frame_bytes(df) if nbytes is None else nbytes
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, size)
+            self._bytes += size
+            # Always keep the newest entry, even when it alone exceeds the limit
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class DiskCache:
+    # Cache directory shared by every worker on the host. Entries are written to a unique temporary file and
+    # renamed into place; an flock on the directory serialises eviction. Access times drive the LRU.
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + suffix)
+
+    def _find(self, key):
+        for suffix in ('.arrow', '.pkl', '.json'):
+            path = self._path(key, suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp') or name == '.lock':
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def get(self, key):
+        path = self._find(key)
+        if path is None:
+            return None
+        try:
+            if path.endswith('.arrow'):
+                # Memory-mapped, see read_arrow for which columns the workers share instead of copying
+                value = read_arrow(path)
+            elif path.endswith('.pkl'):
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+            else:
+                with open(path) as f:
+                    value = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            return None
+        return value
+
+    def put(self, key, value, nbytes=None):
+        # Serialised before any file is opened, values that are not plain JSON (e.g. dicts of DataFrames) are pickled
+        text = plain_json(value) if isinstance(value, (dict, list)) else None
+        if isinstance(value, pd.DataFrame) and feather is not None:
+            path = self._path(key, '.arrow')
+            with replacing(path) as tmp:
+                write_arrow(value, tmp)
+        elif text is not None:
+            path = self._path(key, '.json')
+            with replacing(path) as tmp, open(tmp, 'w') as f:
+                f.write(text)
+        else:
+            path = self._path(key, '.pkl')
+            with replacing(path) as tmp, open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._evict(keep=os.path.basename(path))
+
+    def _evict(self, keep):
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        for _, _, name in self._entries():
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class RedisCache:
+    # Any Redis-compatible server (a local Redis or a stand-in). Values are pickled, a sorted set of
+    # access times and a hash of sizes keep the total under max_bytes with LRU eviction.
+
+    def __init__(self, url=REDIS_URL, max_bytes=MAX_BYTES, prefix='dash_mobility:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def __contains__(self, key):
+        return bool(self.client.exists(self._key(key)))
+
+    def __len__(self):
+        return self.client.zcard(self.prefix + 'lru')
+
+    @property
+    def nbytes(self):
+        return sum(int(size) for size in self.client.hvals(self.prefix + 'sizes'))
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        if data is None:
+            return None
+        self.client.zadd(self.prefix + 'lru', {key: time.time()})
+        return pickle.loads(data)
+
+    def put(self, key, value, nbytes=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        pipe = self.client.pipeline()
+        pipe.set(self._key(key), data)
+        pipe.hset(self.prefix + 'sizes', key, len(data))
+        pipe.zadd(self.prefix + 'lru', {key: time.time()})
+        pipe.execute()
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        total = self.nbytes
+        for oldest in self.client.zrange(self.prefix + 'lru', 0, -1):
+            if total <= self.max_bytes:
+                break
+            oldest = oldest.decode()
+            if oldest == keep:
+                continue
+            total -= int(self.client.hget(self.prefix + 'sizes', oldest) or 0)
+            pipe = self.client.pipeline()
+            pipe.delete(self._key(oldest))
+            pipe.hdel(self.prefix + 'sizes', oldest)
+            pipe.zrem(self.prefix + 'lru', oldest)
+            pipe.execute()
+
+    def clear(self):
+        keys = [self._key(key.decode()) for key in self.client.zrange(self.prefix + 'lru', 0, -1)]
+        self.client.delete(self.prefix + 'lru', self.prefix + 'sizes', *keys)
+
+
+def make_cache(backend=CACHE_BACKEND):
+    if backend == 'disk':
+        return DiskCache()
+    elif backend == 'redis':
+        return RedisCache()
+    return DatasetCache()
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+from data_processing import DEFAULT_TIME_BIN, TIME_BINS, time_bins
+from metrics import instrumented
+from visualization import COLORS, PERIODS
+
+# Demographic breakdowns of the kilometres travelled, as named in the color dropdown
+DEMOGRAPHICS = {'gender': 'Gender', 'age': 'Age', 'education_category': 'Education', 'range_income': 'Income'}
+# Columns of the trip table a comparison reads
+METRIC_COLUMNS = ['label', 'mode', 'start_time', 'travel_time', 'total_distance'] + list(DEMOGRAPHICS)
+# Per-trip values summarized per label, travel_time is in hours and total_distance in kilometres
+SUMMARY_VALUES = ['travel_time', 'total_distance']
+QUANTILES = [0.1, 0.5, 0.9]
+# Tables of a comparison, each one has a label column
+TABLES = ['groups', 'time', 'summary']
+
+
+def plain_values(values):
+    # Comparison tables are small, plain strings are simpler to pivot and merge than categoricals
+    return values.astype(object).where(values.notna(), 'unknown').astype(str).to_numpy()
+
+
+@instrumented('scenario_metrics')
+def scenario_metrics(df, time_bin=min(TIME_BINS)):
+    # Everything a comparison shows, for every label of the frame at once. Mode shares and kilometres by mode
+    # and demographic all come from the one label x mode x demographics grouping, and the deltas against a
+    # baseline from these tables, so comparing more scenarios adds rows instead of re-scanning trips.
+    groups = (
+        df.groupby(['label', 'mode'] + list(DEMOGRAPHICS), observed=True, sort=True, dropna=False)
+        .agg(trips=('start_time', 'size'), travel_time=('travel_time', 'sum'), vkt=('total_distance', 'sum'))
+        .reset_index()
+    )
+    for column in ['label', 'mode'] + list(DEMOGRAPHICS):
+        groups[column] = plain_values(groups[column])
+
+    # Trips per time bin at the finest bin, re-binned when drawn
+    time = (
+        df.assign(time_range=time_bins(df['start_time'], time_bin))
+        .groupby(['label', 'time_range'], observed=True, sort=True)
+        .size()
+        .rename('trips')
+        .reset_index()
+    )
+    time['label'] = plain_values(time['label'])
+
+    grouped = df.groupby('label', observed=True, sort=True)[SUMMARY_VALUES]
+    quantiles = grouped.quantile(QUANTILES).unstack()
+    quantiles.columns = [f'{column}_p{int(q * 100)}' for column, q in quantiles.columns]
+    summary = grouped.mean().add_suffix('_mean').join(quantiles)
+    summary.insert(0, 'trips', grouped.size())
+    summary['vkt'] = grouped.sum()['total_distance']
+    summary = summary.reset_index()
+    summary['label'] = plain_values(summary['label'])
+
+    return {'time_bin': time_bin, 'groups': groups, 'time': time, 'summary': summary}
+
+
+def metrics_bytes(metrics):
+    return sum(int(metrics[table].memory_usage(deep=True).sum()) for table in TABLES)
+
+
+def combine_metrics(parts, labels):
+    # Metrics of single-scenario partitions under the dataset's labels. Each partition is one label,
+    # so even the quantiles stay exact when the tables are only concatenated.
+    combined = {'time_bin': parts[0]['time_bin'] if parts else min(TIME_BINS), 'labels': list(labels)}
+    for table in TABLES:
+        combined[table] = pd.concat(
+            [part[table].assign(label=label) for part, label in zip(parts, labels)], ignore_index=True
+        )
+    return combined
+
+
+def deltas(table, keys, value, baseline, labels):
+    # Every label against the baseline on the same keys, from one pivot. Keys missing from a label count
+    # as zero, change is the relative difference in percent (NaN where the baseline is zero).
+    wide = table.pivot_table(index=keys, columns='label', values=value, aggfunc='sum', fill_value=0)
+    wide = wide.reindex(columns=labels, fill_value=0)
+    base = wide[baseline]
+    long = wide.reset_index().melt(id_vars=keys, var_name='label', value_name=value)
+    long['baseline'] = np.tile(base.to_numpy(), len(labels))
+    long['delta'] = long[value] - long['baseline']
+    long['change'] = 100 * long['delta'] / long['baseline'].where(long['baseline'] != 0)
+    return long
+
+
+def mode_shares(metrics):
+    # Percentage of each label's trips made with each mode
+    shares = metrics['groups'].groupby(['label', 'mode'], sort=False)['trips'].sum().reset_index()
+    shares['share'] = 100 * shares['trips'] / shares.groupby('label')['trips'].transform('sum')
+    return shares
+
+
+def time_profile(metrics, time_bin=DEFAULT_TIME_BIN):
+    time = metrics['time'].assign(time_range=time_bins(metrics['time']['time_range'], time_bin))
+    return time.groupby(['label', 'time_range'], sort=False)['trips'].sum().reset_index()
+
+
+def summary_table(metrics, baseline):
+    # One row per label for display: travel time in minutes, distances in kilometres,
+    # and the change against the baseline next to every value of the other labels
+    summary = metrics['summary'].set_index('label').reindex(metrics['labels'])
+    for column in summary:
+        if column.startswith('travel_time'):
+            summary[column] = summary[column] * 60
+    change = 100 * (summary - summary.loc[baseline]) / summary.loc[baseline].where(summary.loc[baseline] != 0)
+    names = {
+        'trips': 'Trips', 'vkt': 'Kilometres travelled',
+        **{f'travel_time_{stat}': f'Travel time {stat} (min)' for stat in ['mean'] + [f'p{int(q * 100)}' for q in QUANTILES]},
+        **{f'total_distance_{stat}': f'Distance {stat} (km)' for stat in ['mean'] + [f'p{int(q * 100)}' for q in QUANTILES]},
+    }
+    table = pd.DataFrame({'Scenario': summary.index})
+    for column, name in names.items():
+        values = [f'{value:,.0f}' if column in ('trips', 'vkt') else f'{value:,.1f}' for value in summary[column]]
+        table[name] = [
+            value if label == baseline or np.isnan(pct) else f'{value} ({pct:+.1f}%)'
+            for value, label, pct in zip(values, summary.index, change[column])
+        ]
+    return table
+
+
+@instrumented('comparison_figure', payload=True)
+def comparison_figure(metrics, baseline, dimension='gender', time_bin=DEFAULT_TIME_BIN):
+    # Differences of every other scenario to the baseline: mode share, trips over the day,
+    # and kilometres travelled by mode and by one demographic dimension
+    labels = metrics['labels']
+    shares = deltas(mode_shares(metrics), ['mode'], 'share', baseline, labels)
+    time = deltas(time_profile(metrics, time_bin), ['time_range'], 'trips', baseline, labels)
+    by_mode = deltas(metrics['groups'], ['mode'], 'vkt', baseline, labels)
+    by_group = deltas(metrics['groups'], [dimension], 'vkt', baseline, labels)
+
+    fig = make_subplots(rows=2, cols=2, vertical_spacing=0.15, subplot_titles=[
+        'Mode share (percentage points)', 'Trips per time bin',
+        'Kilometres travelled by mode', f'Kilometres travelled by {DEMOGRAPHICS[dimension].lower()}',
+    ])
+    for i, label in enumerate(label for label in labels if label != baseline):
+        style = dict(name=str(label), legendgroup=str(label), marker_color=COLORS[i % len(COLORS)])
+        rows = shares[shares['label'] == label]
+        fig.add_trace(go.Bar(x=rows['mode'], y=rows['delta'], **style), row=1, col=1)
+        rows = time[time['label'] == label].sort_values('time_range')
+        fig.add_trace(go.Scatter(x=rows['time_range'] / 3600, y=rows['delta'], mode='lines', showlegend=False,
+                                 name=str(label), legendgroup=str(label), line_color=style['marker_color']), row=1, col=2)
+        rows = by_mode[by_mode['label'] == label]
+        fig.add_trace(go.Bar(x=rows['mode'], y=rows['delta'], showlegend=False, **style), row=2, col=1)
+        rows = by_group[by_group['label'] == label]
+        fig.add_trace(go.Bar(x=rows[dimension], y=rows['delta'], showlegend=False, **style), row=2, col=2)
+
+    for x0, x1, _, color in PERIODS:
+        fig.add_vrect(x0=x0, x1=x1, fillcolor=color, opacity=0.15, line_width=0, row=1, col=2)
+    fig.add_hline(y=0, line_width=1, line_color='grey')
+    fig.update_xaxes(title_text='Hour of day', row=1, col=2)
+    fig.update_yaxes(title_text=f'Difference to {baseline}', col=1)
+    fig.update_layout(title=f'Scenarios compared with {baseline}', barmode='group', height=800)
+    return fig
@@ -1,130 +1,297 @@
 import base64
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 import io
-import geopandas as gpd
+from pandas.api.types import union_categoricals
 
-def process_files(contents, label_prefix='scenario'):
-    if contents is not None:
-        combined_data = pd.DataFrame()  # Create an empty DataFrame to store the combined data
-        
-        for i, content in enumerate(contents):
-            decoded_content = base64.b64decode(content.split(',')[1])  # Decode the base64-encoded content
-            df = pd.read_csv(io.StringIO(decoded_content.decode('utf-8')))  # Read CSV data into DataFrame
-            
-            # Define headers and column types
-            headers = [
-                'person_id', 'trip_id', 'subtrip_id', 'origin_type', 'origin_node', 'origin_taz', 'destination_type',
-                'destination_node', 'destination_taz', 'mode', 'start_time', 'end_time', 'travel_time', 'total_distance',
-                'cbd_entry_node', 'cbd_exit_node', 'cbd_entry_time', 'cbd_exit_time', 'cbd_travel_time',
-                'non_cbd_travel_time', 'cbd_distance', 'non_cbd_distance', 'extra'
-            ]
-            
-            column_types = {
-                'person_id': str,
-                'trip_id': str,
-                'subtrip_id': str,
-                'origin_type': str,
-                'origin_node': str,
-                'origin_taz': str,
-                'destination_type': str,
-                'destination_node': str,
-                'destination_taz': str,
-                'mode': str,
-                'start_time': str,
-                'end_time': str,
-                'travel_time': float,
-                'total_distance': float,
-                'cbd_entry_node': str,
-                'cbd_exit_node': str,
-                'cbd_entry_time': str,
-                'cbd_exit_time': str,
-                'cbd_travel_time': str,
-                'non_cbd_travel_time': float,
-                'cbd_distance': float,
-                'non_cbd_distance': float,
-                'extra': float,
-            }
-        
-            # Apply headers and column types to the DataFrame
-            df.columns = headers
-            df = df.astype(column_types)
-            
-            # Perform data transformations
-            df['person_id'] = df['person_id'].str.split('-', expand=True)[0]
-            df['person_id'] = df['person_id'].astype(int)
-            time_columns = ['start_time', 'end_time', 'cbd_exit_time', 'cbd_travel_time']
-            df[time_columns] = df[time_columns].apply(pd.to_datetime, format='%H:%M:%S')
-            # Generate the ranges of 30 minutes using pd.date_range()
-            df['time_range'] =  df['start_time'].dt.floor('30T')
-            #Create column for the general distribution
-            df['distr'] =  'count'
-            
-            # Add an iterative label column
-            label = f'{label_prefix}_{i + 1}'
-            df['label'] = label
-                
-            # Append the processed DataFrame to the list
-            combined_data = combined_data.append(df)
-            
-            
-        # Load population details
-        df_population = pd.read_csv('data/population/categories_vc.csv', delimiter=',').rename(columns={"id": "person_id"})
-        gender_df = pd.read_csv('data/population/gender.csv', delimiter=',').rename(columns={"id": "gender_id", "name": "gender"})
-        education_df = pd.read_csv('data/population/education.csv', delimiter=',').rename(columns={"id": "education_type_id", "name": "education_category"})
-        vehicle_df = pd.read_csv('data/population/vehicle_category.csv', delimiter=',').rename(columns={"id": "vehicle_category_id", "name": "vehicle_name"})
-        age_df = pd.read_csv('data/population/age.csv', delimiter=',').rename(columns={"id": "age_category_id", "name": "age"})
-        income_df = pd.read_csv('data/population/income.csv', delimiter=',').rename(columns={"id": "income_id", "name": "income_range"})
-        
-        
-        zones = gpd.read_file('data/shp_files/sm_zone.shp')
-        zones = zones.to_crs(epsg=4326)
-        nodes = gpd.read_file('data/shp_files/node.shp')
-        nodes = nodes.to_crs(epsg=4326)
-        
-        
-        
-        # Merge population details with the appended DataFrame
-        appended_df = pd.merge(combined_data, df_population, on='person_id', how='inner')
-        appended_df = pd.merge(appended_df, gender_df, on='gender_id', how='inner')
-        appended_df = pd.merge(appended_df, education_df, on='education_type_id', how='inner')
-        appended_df = pd.merge(appended_df, vehicle_df, on='vehicle_category_id', how='inner')
-        appended_df = pd.merge(appended_df, age_df, on='age_category_id', how='inner')
-        
-            #merge locations
-        appended_df = pd.merge(appended_df, nodes, left_on = 'origin_node',right_on='id', how='inner')
+from metrics import stage
+from reference_data import get_reference_data, lookup_nodes, lookup_persons, lookup_zones
 
-        appended_df = appended_df.rename(columns={'geometry': 'geometry_origin'})
-        
-                
-        appended_df = pd.merge(appended_df, nodes, left_on = 'destination_node',right_on='id', how='inner')
+logger = logging.getLogger(__name__)
 
-        appended_df = appended_df.rename(columns={'geometry': 'geometry_destination'})
-        
-        appended_df['origin_lat'] = appended_df['geometry_origin'].apply(lambda point: point.y)
-        appended_df['origin_long'] = appended_df['geometry_origin'].apply(lambda point: point.x)
-        
-        appended_df['destination_lat'] = appended_df['geometry_destination'].apply(lambda point: point.y)
-        appended_df['destination_long'] = appended_df['geometry_destination'].apply(lambda point: point.x)
-        
-        # Get income ranges and labels as lists
-        income_ranges = sorted(list(income_df['low_limit']) + [float('inf')])
-        income_labels = list(income_df['income_range'])
+# Define headers and column types of SimMobility subtrip files
+HEADERS = [
+    'person_id', 'trip_id', 'subtrip_id', 'origin_type', 'origin_node', 'origin_taz', 'destination_type',
+    'destination_node', 'destination_taz', 'mode', 'start_time', 'end_time', 'travel_time', 'total_distance',
+    'cbd_entry_node', 'cbd_exit_node', 'cbd_entry_time', 'cbd_exit_time', 'cbd_travel_time',
+    'non_cbd_travel_time', 'cbd_distance', 'non_cbd_distance', 'extra'
+]
 
-        # Assign label based on income range
-        appended_df['range_income'] = pd.cut(appended_df['income'], bins=income_ranges, labels=income_labels, right=False, include_lowest=True)
-        
-        # Map boolean columns using dictionary
-        boolean_columns = ['work_at_home', 'car_license', 'motor_license', 'vanbus_license', 'fixed_workplace', 'is_student']
-        mapping_dict = {'f': False, 't': True}
-        appended_df[boolean_columns] = appended_df[boolean_columns].replace(mapping_dict)
-        
-        # Select and reorder columns
-        columns_to_keep = [
-            'person_id', 'trip_id', 'mode', 'start_time', 'time_range','travel_time',
-            'total_distance',  'gender', 'education_category', 'vehicle_name', 'age',
-            'range_income', 'label','distr','origin_lat','origin_long','destination_lat','destination_long'
-        ]
-        appended_df = appended_df[columns_to_keep]
+# Columns that survive into the processed frame, typed at parse time
+SUBTRIP_COLUMNS = {
+    'person_id': str,
+    'trip_id': str,
+    'origin_node': str,
+    'origin_taz': 'float32',
+    'destination_node': str,
+    'destination_taz': 'float32',
+    'mode': 'category',
+    'start_time': str,
+    'travel_time': 'float32',
+    'total_distance': 'float32',
+}
+
+# Columns of the processed trip table, in order
+TRIP_COLUMNS = [
+    'person_id', 'trip_id', 'mode', 'start_time', 'time_range','travel_time',
+    'total_distance',  'gender', 'education_category', 'vehicle_name', 'age',
+    'range_income', 'label','distr','origin_lat','origin_long','destination_lat','destination_long',
+    'origin_taz', 'destination_taz'
+]
+
+# Low-cardinality dimensions and coordinates of the processed trip table
+CATEGORICAL_COLUMNS = ['mode', 'gender', 'education_category', 'vehicle_name', 'age', 'range_income', 'label']
+COORDINATE_COLUMNS = ['origin_lat', 'origin_long', 'destination_lat', 'destination_long']
+
+# Selectable widths, in minutes, of the time_range bins
+TIME_BINS = [5, 15, 30, 60]
+DEFAULT_TIME_BIN = 30
+
+# Worker processes used to parse scenario files, 0 or 1 parses them one after another
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 0))
+
+# pyarrow parses CSVs multi-threaded, the C engine is the fallback when it is not installed
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+
+def file_columns(source):
+    # Header names of a subtrip file, rewinding file handles so the full read starts at the top
+    if hasattr(source, 'seek'):
+        position = source.tell()
+        columns = pd.read_csv(source, nrows=0).columns
+        source.seek(position)
+        return columns
+    return pd.read_csv(source, nrows=0).columns
+
+
+def read_subtrip_csv(source, engine=None, chunksize=None):
+    # Read only the needed columns of a subtrip file (path or file handle), applying the schema while parsing.
+    # Columns are picked by position because the header names in the files are not reliable.
+    # With chunksize the frames come one chunk at a time (C engine only, pyarrow cannot stream).
+    names = dict(zip(file_columns(source), HEADERS))
+    selected = {column: name for column, name in names.items() if name in SUBTRIP_COLUMNS}
+    reader = pd.read_csv(
+        source,
+        usecols=list(selected),
+        dtype={column: SUBTRIP_COLUMNS[name] for column, name in selected.items()},
+        engine='c' if chunksize else engine or CSV_ENGINE,
+        chunksize=chunksize,
+    )
+    if chunksize:
+        return (df.rename(columns=selected)[list(SUBTRIP_COLUMNS)] for df in reader)
+    return reader.rename(columns=selected)[list(SUBTRIP_COLUMNS)]
+
+
+def decode_upload(content):
+    # dcc.Upload contents are data URLs, keep the decoded bytes without another utf-8 string copy
+    return io.BytesIO(base64.b64decode(content.split(',', 1)[1]))
+
+
+def scenario_source(content):
+    # Uploads arrive as dcc.Upload data URLs or as paths of files spooled by the chunked upload endpoint
+    return decode_upload(content) if content.startswith('data:') else content
+
+
+def parse_time_seconds(column):
+    # 'HH:MM:SS' strings to int32 seconds since midnight, keeping SimMobility times past 24:00:00
+    if len(column) == 0:
+        # A header-only file, the split fallback cannot expand an empty column
+        return np.array([], dtype=np.int32)
+    raw = column.to_numpy(dtype=str).astype('S')
+    if raw.dtype.itemsize == 8:
+        digits = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(-1, 8).astype(np.int32) - ord('0')
+        if ((digits[:, 2] == 10) & (digits[:, 5] == 10)).all():
+            return (
+                (digits[:, 0] * 10 + digits[:, 1]) * 3600
+                + (digits[:, 3] * 10 + digits[:, 4]) * 60
+                + digits[:, 6] * 10 + digits[:, 7]
+            ).astype(np.int32)
+    # Fall back to splitting when hours are not two digits wide
+    parts = column.str.split(':', n=2, expand=True).astype(np.int32).to_numpy()
+    return (parts[:, 0] * 3600 + parts[:, 1] * 60 + parts[:, 2]).astype(np.int32)
+
+
+def time_bins(seconds, minutes=DEFAULT_TIME_BIN):
+    # Floor seconds since midnight to the start of their time bin
+    width = minutes * 60
+    return (np.asarray(seconds) // width * width).astype(np.int32)
+
+
+def parse_scenario(source, label, engine=None, time_bin=DEFAULT_TIME_BIN):
+    return type_subtrips(read_subtrip_csv(source, engine), label, time_bin)
+
+
+def type_subtrips(df, label, time_bin=DEFAULT_TIME_BIN):
+    # Perform data transformations
+    df['person_id'] = df['person_id'].str.split('-', n=1).str[0].astype(np.int64)
+    df['start_time'] = parse_time_seconds(df['start_time'])
+    # Generate the ranges of time_bin minutes
+    df['time_range'] = time_bins(df['start_time'], time_bin)
+
+    df['label'] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), categories=[label])
+    return df
+
+
+def read_scenario(content, label, engine=None, time_bin=DEFAULT_TIME_BIN):
+    return parse_scenario(scenario_source(content), label, engine, time_bin)
+
+
+def combine_scenarios(frames):
+    # Concatenate once at the end instead of appending per file, which copies the accumulated frame every time
+    if not frames:
+        return pd.DataFrame(columns=list(SUBTRIP_COLUMNS))
+    # Categories differ between files, unify them so the concatenated column stays categorical
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = union_categoricals([df[column] for df in frames]).categories
+            frames = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def attach_person_attributes(df, person_table):
+    # Take each trip's demographic attributes by position from the person table
+    positions, found = lookup_persons(person_table, df['person_id'])
+    if not found.all():
+        df = df[found]
+        positions = positions[found]
+    attributes = person_table.attributes.take(positions)
+    return df.assign(**{name: attributes[name].array for name in attributes.columns})
+
+
+def node_ids(column):
+    # Node ids arrive as strings, anything non-numeric can never match a node
+    return pd.to_numeric(column, errors='coerce').fillna(-1).to_numpy(np.int64)
+
+
+def trip_zones(taz, node_zone, zone_index):
+    # TAZ from the file where it names a known zone, otherwise the zone the node lies in (-1 for neither)
+    taz = pd.Series(taz).fillna(-1).to_numpy(np.int64)
+    _, known = lookup_zones(zone_index, taz)
+    return np.where(known, taz, node_zone).astype(np.int32)
+
+
+def attach_node_coordinates(df, node_index, zone_index=None):
+    # Resolve origin and destination nodes with one lookup over both columns
+    n = len(df)
+    positions, found = lookup_nodes(node_index, np.concatenate([node_ids(df['origin_node']), node_ids(df['destination_node'])]))
+    origin, destination = positions[:n], positions[n:]
+    matched = found[:n] & found[n:]
+
+    if not matched.all():
+        unmatched = pd.unique(np.concatenate([
+            df['origin_node'].to_numpy()[~found[:n]], df['destination_node'].to_numpy()[~found[n:]]
+        ]))
+        logger.warning('Dropping %d of %d trips with nodes missing from node.shp (%d unknown node ids, e.g. %s)',
+                       int((~matched).sum()), n, len(unmatched), ', '.join(map(str, unmatched[:5])))
+        df = df[matched]
+        origin, destination = origin[matched], destination[matched]
+    df.attrs['unmatched_trips'] = int(n - len(df))
+
+    df = df.assign(
+        origin_lat=node_index.lat[origin],
+        origin_long=node_index.lon[origin],
+        destination_lat=node_index.lat[destination],
+        destination_long=node_index.lon[destination],
+    )
+    if zone_index is not None:
+        df = df.assign(
+            origin_taz=trip_zones(df['origin_taz'], node_index.zone[origin], zone_index),
+            destination_taz=trip_zones(df['destination_taz'], node_index.zone[destination], zone_index),
+        )
+    return df
+
+
+def compact_trip_table(df):
+    # Categoricals for every dimension, float32 coordinates, int32 ids and times, 'distr' left virtual
+    types = {column: 'category' for column in CATEGORICAL_COLUMNS if column in df}
+    types.update({column: np.float32 for column in COORDINATE_COLUMNS if column in df})
+    types.update({column: np.int32 for column in ['start_time', 'time_range'] if column in df})
+    if 'person_id' in df and (len(df) == 0 or df['person_id'].max() <= np.iinfo(np.int32).max):
+        types['person_id'] = np.int32
+    return df.drop(columns=['distr'], errors='ignore').astype(types)
+
+
+def bytes_per_row(df):
+    return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+
+def no_progress(stage, fraction=0.0):
+    pass
+
+
+def read_scenarios(contents, labels, time_bin=DEFAULT_TIME_BIN, workers=None, progress=no_progress):
+    # Scenarios are independent until enrichment, so they can be parsed in a process pool
+    workers = INGEST_WORKERS if workers is None else workers
+    workers = min(workers, len(contents))
+    if workers <= 1:
+        frames = []
+        for i, (content, label) in enumerate(zip(contents, labels)):
+            progress('decode', i / len(contents))
+            with stage('decode'):
+                source = scenario_source(content)
+            progress('parse', i / len(contents))
+            with stage('parse') as record:
+                frames.append(parse_scenario(source, label, time_bin=time_bin))
+                record['rows_out'] = len(frames[-1])
+        return frames
+    with ProcessPoolExecutor(max_workers=workers) as pool, stage('decode+parse') as record:
+        progress('parse')
+        futures = [pool.submit(read_scenario, content, label, None, time_bin) for content, label in zip(contents, labels)]
+        for done, _ in enumerate(as_completed(futures), start=1):
+            progress('parse', done / len(futures))
+        frames = [future.result() for future in futures]
+        record['rows_out'] = sum(len(df) for df in frames)
+        return frames
+
+
+def scenario_label(filename, default):
+    # Stable label of a scenario: its file name without the extension
+    return os.path.splitext(os.path.basename(filename))[0] if filename else default
+
+
+def enrich_trips(df, reference, progress=no_progress):
+    # Attach demographics and node coordinates through the precomputed indexes
+    progress('enrich')
+    with stage('enrich', len(df)) as record:
+        df = attach_person_attributes(df, reference.person_table)
+        record['rows_out'] = len(df)
+    progress('geo-join')
+    with stage('geo-join', len(df)) as record:
+        df = attach_node_coordinates(df, reference.node_index, reference.zone_index)
+        record['rows_out'] = len(df)
+
+    #Create column for the general distribution
+    df['distr'] = 'count'
+
+    # Select and reorder columns
+    return df[TRIP_COLUMNS]
+
+
+def process_files(contents, label_prefix='scenario', time_bin=DEFAULT_TIME_BIN, compact=False, workers=None,
+                  progress=no_progress, labels=None):
+    # progress(stage, fraction) is called at every stage boundary, it may raise to abort processing
+    if contents is not None:
+        # Add an iterative label column to each scenario (unless labels are given) and combine them in a single pass
+        labels = labels or [f'{label_prefix}_{i + 1}' for i in range(len(contents))]
+        frames = read_scenarios(contents, labels, time_bin, workers, progress)
+        with stage('combine') as record:
+            combined_data = combine_scenarios(frames)
+            record['rows_out'] = len(combined_data)
+
+        # Reference tables are loaded once per process and shared between callbacks
+        appended_df = enrich_trips(combined_data, get_reference_data(), progress)
+
+        if compact:
+            with stage('compact', len(appended_df)):
+                appended_df = compact_trip_table(appended_df)
+        logger.info('Processed %d trips from %d files, %.1f bytes per row', len(appended_df), len(contents), bytes_per_row(appended_df))
         
         return appended_df
 
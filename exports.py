@@ -0,0 +1,46 @@
+import re
+
+from flask import Response, request
+
+from cache import cached_map_html, cached_od
+from data_processing import DEFAULT_TIME_BIN, TIME_BINS
+from od_matrix import od_export
+
+# Dataset keys are partition sha1s joined with '+'
+DATASET_KEY = re.compile(r'^[0-9a-f]{40}(\+[0-9a-f]{40})*$')
+
+
+def od_export_url(dataset_key, time_bin=DEFAULT_TIME_BIN):
+    return f'/export/od/{dataset_key}.csv?time_bin={time_bin}'
+
+
+def map_url(dataset_key):
+    return f'/map/{dataset_key}.html'
+
+
+def register_export_routes(server):
+    # Downloads are served by Flask so large tables never pass through a Dash callback
+
+    @server.route('/export/od/<dataset_key>.csv', methods=['GET'])
+    def export_od(dataset_key):
+        time_bin = request.args.get('time_bin', DEFAULT_TIME_BIN, type=int)
+        if not DATASET_KEY.match(dataset_key) or time_bin not in TIME_BINS:
+            return Response('Invalid dataset or time bin', status=400)
+        od = cached_od(dataset_key, time_bin)
+        if od is None:
+            return Response('Unknown dataset', status=404)
+        return Response(
+            od_export(od).to_csv(index=False),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=od_matrix_{time_bin}min.csv'},
+        )
+
+    @server.route('/map/<dataset_key>.html', methods=['GET'])
+    def trip_map(dataset_key):
+        # Served to an iframe, the Kepler page is several megabytes
+        if not DATASET_KEY.match(dataset_key):
+            return Response('Invalid dataset', status=400)
+        html = cached_map_html(dataset_key)
+        if html is None:
+            return Response('Unknown dataset', status=404)
+        return Response(html, mimetype='text/html')
@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+
+from flask import jsonify
+
+from reference_data import get_reference_data, reference_loaded
+from scenario_store import STORE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent importing the app, measured by wsgi
+import_seconds = None
+
+_warming = None
+_warming_lock = threading.Lock()
+
+
+def load_reference_data_quietly():
+    try:
+        get_reference_data()
+    except FileNotFoundError as error:
+        logger.warning('Reference data not loaded: %s', error)
+
+
+def warm_up():
+    # A worker that was not preloaded loads the reference data in the background and becomes ready on its own
+    global _warming
+    with _warming_lock:
+        if _warming is None or not _warming.is_alive():
+            _warming = threading.Thread(target=load_reference_data_quietly, daemon=True)
+            _warming.start()
+
+
+def store_writable():
+    try:
+        os.makedirs(STORE_DIR, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(STORE_DIR, os.W_OK)
+
+
+def readiness():
+    checks = {'reference_data': reference_loaded(), 'scenario_store': store_writable()}
+    return all(checks.values()), checks
+
+
+def register_health_routes(server):
+    # /ready answers 503 until this worker can serve a processing request without loading anything first
+
+    @server.route('/ready', methods=['GET'])
+    def ready():
+        is_ready, checks = readiness()
+        if not checks['reference_data']:
+            warm_up()
+        body = jsonify(ready=is_ready, checks=checks, pid=os.getpid(), import_seconds=import_seconds)
+        return body, 200 if is_ready else 503
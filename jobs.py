@@ -0,0 +1,238 @@
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import plotly
+
+from cache import cached_partition, has_partition, partition_cube, partition_key
+from data_processing import INGEST_WORKERS, no_progress
+from metrics import flush_metrics
+from preview import preview_cube
+from reference_data import get_reference_data
+from uploads import remove_upload
+
+# Jobs keep their status and results on disk, so any gunicorn worker can poll them
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'dash_mobility_jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_TTL = 24 * 3600
+
+# Share of the overall progress reached when each stage starts
+STAGES = {
+    'queued': 0,
+    'decode': 5,
+    'parse': 10,
+    'enrich': 60,
+    'geo-join': 75,
+    'aggregate': 85,
+    'done': 100,
+}
+
+_executor = None
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_path(job_id, name=''):
+    return os.path.join(JOBS_DIR, job_id, name)
+
+
+def write_status(job_id, **status):
+    # Write to a temporary file and rename, so readers never see half a status
+    path = job_path(job_id, 'status.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f)
+    os.replace(path + '.tmp', path)
+
+
+def job_status(job_id):
+    try:
+        with open(job_path(job_id, 'status.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'state': 'missing', 'stage': None, 'progress': 0}
+
+
+def stage_progress(stage, fraction=0.0):
+    # Overall percentage for a stage and how far it is through it
+    stages = list(STAGES)
+    start = STAGES[stage]
+    end = STAGES[stages[min(stages.index(stage) + 1, len(stages) - 1)]]
+    return round(start + (end - start) * fraction)
+
+
+def write_preview(job_id, contents, labels):
+    # Histogram of a sample of the files, drawn while they are processed in full
+    write_status(job_id, state='running', stage='preview', progress=0)
+    try:
+        cube = preview_cube(contents, labels)
+    except Exception:
+        # The exact histogram follows anyway
+        logger.exception('Preview of job %s failed', job_id)
+        return
+    if cube is not None:
+        path = job_path(job_id, 'preview.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(cube, f, cls=plotly.utils.PlotlyJSONEncoder)
+        os.replace(path + '.tmp', path)
+
+
+def has_job_preview(job_id):
+    return os.path.exists(job_path(job_id, 'preview.json'))
+
+
+def load_job_preview(job_id):
+    try:
+        with open(job_path(job_id, 'preview.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def check_cancelled(job_id, stage=None, fraction=0.0):
+    # Progress callback of a partition processed in an ingest worker, which only needs to see a cancellation
+    if os.path.exists(job_path(job_id, 'cancel')):
+        raise JobCancelled()
+
+
+def process_partition(content, label, progress=no_progress):
+    key = cached_partition(content, label, progress)
+    progress('aggregate')
+    partition_cube(key)
+    # The partition is stored, the spooled file only takes space that later uploads need
+    remove_upload(content)
+    flush_metrics()
+    return key
+
+
+def parallel_partitions(job_id, contents, labels, workers):
+    # One file per ingest worker, forked after the reference data is loaded so the workers share it
+    get_reference_data()
+    write_status(job_id, state='running', stage=f'processing {len(contents)} files', progress=0)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(process_partition, content, label, functools.partial(check_cancelled, job_id))
+            for content, label in zip(contents, labels)
+        ]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                check_cancelled(job_id)
+                write_status(job_id, state='running', stage=f'processed {done}/{len(contents)} files',
+                             progress=round(100 * done / len(contents)))
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        return [future.result() for future in futures]
+
+
+def run_job(job_id, contents, labels):
+    # Each file becomes its own partition, files processed before are picked up from the store.
+    # With INGEST_WORKERS above 1 several files are processed at once.
+    keys = []
+
+    def progress(stage, fraction=0.0):
+        check_cancelled(job_id)
+        overall = (len(keys) + stage_progress(stage, fraction) / 100) / len(contents)
+        write_status(job_id, state='running', stage=f'{stage} ({len(keys) + 1}/{len(contents)})', progress=round(100 * overall))
+
+    try:
+        # Files processed before come from the store at once, a preview only helps with new ones
+        if not all(has_partition(partition_key(content)) for content in contents):
+            write_preview(job_id, contents, labels)
+        workers = min(INGEST_WORKERS, len(contents))
+        if workers > 1:
+            keys = parallel_partitions(job_id, contents, labels, workers)
+        else:
+            for content, label in zip(contents, labels):
+                keys.append(process_partition(content, label, progress))
+        write_status(job_id, state='done', stage='done', progress=100, partitions=keys)
+    except JobCancelled:
+        write_status(job_id, state='cancelled', stage=None, progress=0)
+    except Exception as error:
+        logger.exception('Job %s failed', job_id)
+        write_status(job_id, state='failed', stage=None, progress=0, error=str(error))
+    finally:
+        flush_metrics()
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+    return _executor
+
+
+def reset_executor(broken):
+    # A job worker that dies (e.g. killed when out of memory) breaks the whole pool, the next job starts a new one
+    global _executor
+    if _executor is broken:
+        _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def job_finished(job_id, pool, future):
+    # run_job records its own errors, an exception here means its worker process died
+    if future.cancelled() or future.exception() is None:
+        return
+    if isinstance(future.exception(), BrokenProcessPool):
+        reset_executor(pool)
+    if job_status(job_id)['state'] in ('queued', 'running'):
+        logger.error('Job %s failed: %s', job_id, future.exception())
+        write_status(job_id, state='failed', stage=None, progress=0, error='the processing worker stopped unexpectedly')
+
+
+def prune_jobs(max_age=JOB_TTL):
+    # Drop job directories that finished long ago
+    if not os.path.isdir(JOBS_DIR):
+        return
+    cutoff = time.time() - max_age
+    for job_id in os.listdir(JOBS_DIR):
+        path = job_path(job_id)
+        # Another worker may be pruning the same directory
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+
+def submit_job(contents, labels):
+    # Start processing the uploads in the background and return the job id to poll
+    prune_jobs()
+    job_id = uuid.uuid4().hex
+    os.makedirs(job_path(job_id))
+    write_status(job_id, state='queued', stage='queued', progress=0)
+    pool = executor()
+    try:
+        future = pool.submit(run_job, job_id, contents, labels)
+    except BrokenProcessPool:
+        reset_executor(pool)
+        pool = executor()
+        future = pool.submit(run_job, job_id, contents, labels)
+    future.add_done_callback(functools.partial(job_finished, job_id, pool))
+    return job_id
+
+
+def cancel_job(job_id):
+    # The job stops at its next stage boundary
+    if os.path.isdir(job_path(job_id)):
+        open(job_path(job_id, 'cancel'), 'w').close()
+
+
+def load_job_result(job_id):
+    # Partition keys of a finished job, the frames themselves live in the scenario store
+    status = job_status(job_id)
+    if status['state'] != 'done':
+        return None
+    return status['partitions']
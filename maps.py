@@ -0,0 +1,260 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_processing import TRIP_COLUMNS
+from kepler_config import config as KEPLER_CONFIG
+from metrics import instrumented
+from od_matrix import od_counts, od_flows, sum_od
+
+logger = logging.getLogger(__name__)
+
+# Target sizes of the datasets embedded in the map, whatever the number of trips
+MAP_POINTS = int(os.environ.get('MAP_POINTS', 50000))
+MAP_ARCS = int(os.environ.get('MAP_ARCS', 5000))
+HEX_METERS = 500
+
+# Kepler parsed the 'HH:MM:SS' start times of the saved config as 1900-01-01 timestamps, in milliseconds
+KEPLER_EPOCH_MS = -2208988800000
+
+# Columns of the sampled trips, the saved config's arc layer and tooltip use them
+POINT_COLUMNS = [
+    'person_id', 'mode', 'start_time', 'travel_time', 'total_distance', 'age', 'label',
+    'origin_lat', 'origin_long', 'destination_lat', 'destination_long',
+]
+# Tables of a scenario's map parts
+MAP_PARTS = ['sample', 'strata', 'od', 'hexbins', 'zones']
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def config_filters(config):
+    # (column, type, value) of every filter on the 'trips' dataset
+    return [
+        (name, trip_filter['type'], trip_filter['value'])
+        for trip_filter in config['config']['visState'].get('filters', [])
+        if 'trips' in trip_filter['dataId']
+        for name in trip_filter['name']
+    ]
+
+
+def apply_filters(df, config, loaded=None, skip=()):
+    # Trips the saved filters would show, applied before aggregating so every layer agrees with them.
+    # loaded holds the values of multiSelect columns across all frames when df is only a part of the data.
+    selected = np.ones(len(df), dtype=bool)
+    for column, kind, value in config_filters(config):
+        if column not in df or not value or column in skip:
+            continue
+        if kind == 'timeRange' and column == 'start_time':
+            start, end = ((np.array(value) - KEPLER_EPOCH_MS) / 1000)
+            selected &= ((df[column] >= start) & (df[column] <= end)).to_numpy()
+        elif kind == 'multiSelect':
+            values = loaded.get(column, set()) if loaded is not None else set(df[column].astype(str).unique())
+            values = [item for item in value if item in values]
+            # A saved selection naming none of the loaded values (e.g. an old scenario label) would hide everything
+            if not values:
+                logger.info('Ignoring the %s filter, none of %s is loaded', column, value)
+                continue
+            selected &= df[column].astype(str).isin(values).to_numpy()
+        elif kind == 'range':
+            selected &= ((df[column] >= value[0]) & (df[column] <= value[1])).to_numpy()
+    return df[selected]
+
+
+def stratified_sample(df, target=MAP_POINTS, strata=('label', 'mode'), seed=0):
+    # Rows of every stratum in proportion to its size, at least one each, so small scenarios and modes stay visible
+    if len(df) <= target:
+        return df
+    # Missing values (e.g. an unknown mode) are a stratum of their own
+    groups = df.groupby(list(strata), observed=True, dropna=False).ngroup().to_numpy()
+    sizes = np.bincount(groups)
+    quota = np.maximum(1, np.round(sizes * target / len(df))).astype(np.int64)
+    # Random order within each stratum, rows ranked below the quota are kept
+    order = np.random.default_rng(seed).permutation(len(df))
+    order = order[np.argsort(groups[order], kind='stable')]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    ranks = np.arange(len(df)) - starts[groups[order]]
+    return df.iloc[np.sort(order[ranks < quota[groups[order]]])]
+
+
+def clock(seconds):
+    # Seconds since midnight as the 'HH:MM:SS' strings the saved time filter was built on
+    seconds = np.asarray(seconds, dtype=np.int64)
+    return pd.Series([f'{h:02d}:{m:02d}:{s:02d}' for h, m, s in zip(seconds // 3600, seconds // 60 % 60, seconds % 60)])
+
+
+def sample_candidates(df, target=MAP_POINTS, strata=('label', 'mode'), seed=0):
+    # The target rows of lowest random priority in every stratum, enough for any stratified sample of at most target
+    # rows. Candidates of chunks combine by keeping the lowest priorities again.
+    df = df.assign(priority=np.random.default_rng(seed).random(len(df)))
+    return df[df.groupby(list(strata), observed=True, dropna=False)['priority'].rank(method='first') <= target]
+
+
+def draw_sample(candidates, sizes, target=MAP_POINTS, strata=('label', 'mode')):
+    # Stratified sample from the candidates, given the trips per stratum of the whole data they were taken from.
+    # Quotas only shrink as more trips are added, so a partition may keep just its own share of candidates.
+    total = sizes.sum()
+    if total <= target:
+        return candidates
+    quota = np.maximum(1, np.round(sizes * target / total)).rename('quota')
+    ranks = candidates.groupby(list(strata), observed=True, dropna=False)['priority'].rank(method='first')
+    quotas = candidates[list(strata)].join(quota, on=list(strata))['quota']
+    return candidates[ranks <= quotas]
+
+
+def hex_cells(lat, lon, center, meters=HEX_METERS):
+    # Trips per pointy-top hexagon (q, r) of the given size, on an equirectangular projection around center latitude
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    scale_x, scale_y = 111320 * np.cos(np.radians(center)), 110540
+    x, y = lon * scale_x / meters, lat * scale_y / meters
+    q, r = np.sqrt(3) / 3 * x - y / 3, 2 / 3 * y
+    # Round the cube coordinates, fixing the component with the largest rounding error
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    rq = np.where((dq > dr) & (dq > ds), -rr - rs, rq)
+    rr = np.where((dr >= dq) & (dr > ds), -rq - rs, rr)
+    cells, trips = np.unique(np.stack([rq, rr], axis=1).reshape(-1, 2), axis=0, return_counts=True)
+    return pd.DataFrame({'q': cells[:, 0].astype(np.int64), 'r': cells[:, 1].astype(np.int64), 'trips': trips})
+
+
+def hex_centers(cells, center, meters=HEX_METERS):
+    scale_x, scale_y = 111320 * np.cos(np.radians(center)), 110540
+    return pd.DataFrame({
+        'lat': cells['r'].to_numpy() * 1.5 * meters / scale_y,
+        'lon': np.sqrt(3) * (cells['q'].to_numpy() + cells['r'].to_numpy() / 2) * meters / scale_x,
+        'trips': cells['trips'].to_numpy(),
+    })
+
+
+def zone_trips(df):
+    # Trips starting and ending in every zone
+    trips = pd.concat({
+        'origins': df['origin_taz'].value_counts(),
+        'destinations': df['destination_taz'].value_counts(),
+    }, axis=1)
+    return trips.fillna(0).astype(np.int64).rename_axis('taz').reset_index()
+
+
+def zone_counts(trips, zones):
+    # Zone trips on the zone polygons
+    trips = trips.set_index('taz')
+    zone_ids = pd.to_numeric(zones['zone_id'])
+    return zones.assign(
+        origins=zone_ids.map(trips['origins']).fillna(0).astype(np.int64).to_numpy(),
+        destinations=zone_ids.map(trips['destinations']).fillna(0).astype(np.int64).to_numpy(),
+    )
+
+
+def map_columns(config=KEPLER_CONFIG):
+    # Stored columns the map is built from: the sampled trips, the zones and whatever the saved filters test
+    filtered = [column for column, _, _ in config_filters(config) if column in TRIP_COLUMNS]
+    return list(dict.fromkeys(POINT_COLUMNS + ['origin_taz', 'destination_taz'] + filtered))
+
+
+def select_columns(config=KEPLER_CONFIG, skip=()):
+    return [column for column, kind, _ in config_filters(config) if kind == 'multiSelect' and column not in skip]
+
+
+def filter_values(batches):
+    # Values of every column across all batches, for multiSelect filters applied batch by batch
+    values = {}
+    for df in batches:
+        for column in df:
+            values.setdefault(column, set()).update(df[column].dropna().astype(str).unique())
+    return values
+
+
+def map_parts(batches, reference, config=KEPLER_CONFIG, loaded=None, points=MAP_POINTS, skip=()):
+    # Additive pieces of the map datasets folded over frames of one scenario or dataset, memory depends on the
+    # largest frame only: candidate trips with the trips per stratum, OD counts, hexagon and zone counts
+    center = reference.node_index.lat.mean()
+    parts = None
+    for seed, df in enumerate(batches):
+        trips = apply_filters(df, config, loaded, skip)
+        more = {
+            'sample': sample_candidates(trips[POINT_COLUMNS], points, seed=seed),
+            'strata': trips.groupby(['label', 'mode'], observed=True, dropna=False).size().rename('trips').reset_index(),
+            'od': od_counts(trips),
+            'hexbins': hex_cells(trips['origin_lat'], trips['origin_long'], center),
+            'zones': zone_trips(trips),
+        }
+        parts = more if parts is None else add_map_parts(parts, more, points)
+    sizes = parts['strata'].set_index(['label', 'mode'])['trips']
+    return dict(parts, sample=draw_sample(parts['sample'], sizes, points))
+
+
+def add_map_parts(parts, more, points=MAP_POINTS):
+    def summed(name, keys, values):
+        return (
+            pd.concat([parts[name], more[name]], ignore_index=True)
+            .groupby(keys, observed=True, dropna=False)[values].sum().reset_index()
+        )
+
+    sample = pd.concat([parts['sample'], more['sample']], ignore_index=True)
+    return {
+        'sample': sample[sample.groupby(['label', 'mode'], observed=True, dropna=False)['priority'].rank(method='first') <= points],
+        'strata': summed('strata', ['label', 'mode'], 'trips'),
+        'od': sum_od([parts['od'], more['od']]),
+        'hexbins': summed('hexbins', ['q', 'r'], 'trips'),
+        'zones': summed('zones', 'taz', ['origins', 'destinations']),
+    }
+
+
+def relabel(parts, label):
+    # Parts of a scenario under its facet label in a dataset
+    return {
+        name: df.assign(label=label) if 'label' in df else df
+        for name, df in parts.items()
+    }
+
+
+def selected_labels(labels, config=KEPLER_CONFIG):
+    # Facet labels the saved label filter keeps, all of them when it names none
+    for column, kind, value in config_filters(config):
+        if column == 'label' and kind == 'multiSelect' and value:
+            kept = [label for label in labels if label in value]
+            if kept:
+                return kept
+            logger.info('Ignoring the label filter, none of %s is loaded', value)
+    return list(labels)
+
+
+def parts_datasets(parts, reference, points=MAP_POINTS, arcs=MAP_ARCS):
+    # Kepler datasets of bounded size from combined map parts: 'trips' keeps the dataId of the saved config
+    sizes = parts['strata'].set_index(['label', 'mode'])['trips']
+    trips = draw_sample(parts['sample'], sizes, points)[POINT_COLUMNS].reset_index(drop=True)
+    flows = od_flows(parts['od'], reference.zone_index)
+    center = reference.node_index.lat.mean()
+    return {
+        'trips': trips.assign(start_time=clock(trips['start_time'])),
+        'flows': flows.nlargest(arcs, 'trips').reset_index(drop=True),
+        'hexbins': hex_centers(parts['hexbins'], center),
+        'zones': zone_counts(parts['zones'], reference.zones),
+    }
+
+
+@instrumented('map_datasets')
+def dataset_map(partitions, labels, reference, config=KEPLER_CONFIG, points=MAP_POINTS, arcs=MAP_ARCS):
+    # Map datasets of the partitions kept by the label filter, from each one's map parts under its facet label
+    kept = selected_labels(labels, config)
+    combined = None
+    for parts, label in zip(partitions, labels):
+        if label in kept:
+            parts = relabel(parts, label)
+            combined = parts if combined is None else add_map_parts(combined, parts, points)
+    return parts_datasets(combined, reference, points, arcs)
+
+
+@instrumented('map_html', payload=True)
+def map_html(datasets, config=KEPLER_CONFIG, height=600):
+    # keplergl is only needed when a map is drawn
+    from keplergl import KeplerGl
+    html = KeplerGl(height=height, data=datasets, config=config)._repr_html_()
+    return html.decode() if isinstance(html, bytes) else html
@@ -0,0 +1,246 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import plotly
+from flask import g, jsonify, request
+
+# Every process (web workers and job workers) writes its stage totals here, /metrics adds them up
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'dash_mobility_metrics'))
+# Lets a request ask for a profile with ?profile=1 or an X-Profile header
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+# Stage totals are written once per request or job, and at most this many seconds apart in between
+FLUSH_SECONDS = 5.0
+
+logger = logging.getLogger('metrics')
+
+_stages = {}
+_lock = threading.Lock()
+_dirty = False
+_flushed = 0.0
+
+
+def clear_after_fork():
+    # A forked ingest, job or web worker starts from empty totals, otherwise /metrics would add the parent's stages
+    # once for every child
+    global _stages, _lock, _dirty, _flushed
+    _stages = {}
+    _lock = threading.Lock()
+    _dirty = False
+    _flushed = 0.0
+
+
+os.register_at_fork(after_in_child=clear_after_fork)
+
+
+def peak_rss_mb():
+    # Peak resident set size of the process, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def payload_bytes(value):
+    # Size of a figure or callback output as it is sent to the browser. Output that is already text (the map HTML)
+    # is measured as it is; figures the cache serializes record their size with record_payload, serializing one
+    # again here is only worth it while profiling, None otherwise.
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if not PROFILE_REQUESTS:
+        return None
+    if hasattr(value, 'to_plotly_json'):
+        value = value.to_plotly_json()
+    return len(json.dumps(value, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    # Wall time and peak RSS growth of one stage; the caller may add rows_out or payload_bytes to the record
+    record = {'stage': name, 'rows_in': rows_in}
+    rss = peak_rss_mb()
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - started
+        record['peak_rss_delta_mb'] = peak_rss_mb() - rss
+        add_record(record)
+
+
+def instrumented(name, payload=False):
+    # Record a function as a stage, with rows of a DataFrame first argument and optionally its output size
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows = len(args[0]) if args and hasattr(args[0], 'columns') else None
+            with stage(name, rows) as record:
+                result = function(*args, **kwargs)
+                size = payload_bytes(result) if payload else None
+                if size is not None:
+                    record['payload_bytes'] = size
+            return result
+        return wrapper
+    return decorator
+
+
+def add_record(record):
+    # Totals are kept in memory, flush_metrics writes them for /metrics
+    global _dirty
+    logger.info(json.dumps(dict(record, pid=os.getpid())))
+    with _lock:
+        totals = _stages.setdefault(record['stage'], {
+            'count': 0, 'seconds_total': 0.0, 'seconds_max': 0.0, 'seconds_last': 0.0,
+            'rows_in': 0, 'rows_out': 0, 'peak_rss_delta_mb_max': 0.0, 'payload_bytes_last': None,
+        })
+        totals['count'] += 1
+        totals['seconds_total'] += record['seconds']
+        totals['seconds_max'] = max(totals['seconds_max'], record['seconds'])
+        totals['seconds_last'] = record['seconds']
+        totals['rows_in'] += record.get('rows_in') or 0
+        totals['rows_out'] += record.get('rows_out') or 0
+        totals['peak_rss_delta_mb_max'] = max(totals['peak_rss_delta_mb_max'], record['peak_rss_delta_mb'])
+        if 'payload_bytes' in record:
+            totals['payload_bytes_last'] = record['payload_bytes']
+        _dirty = True
+        due = time.monotonic() - _flushed >= FLUSH_SECONDS
+    if due:
+        flush_metrics()
+
+
+def record_payload(name, nbytes):
+    # Output size of a stage measured where the output is serialized anyway, e.g. to size a cache entry
+    global _dirty
+    with _lock:
+        if name in _stages:
+            _stages[name]['payload_bytes_last'] = nbytes
+            _dirty = True
+
+
+def flush_metrics():
+    # Write the totals of this process if a stage was recorded since the last write
+    global _dirty, _flushed
+    with _lock:
+        if not _dirty:
+            return
+        write_process_metrics(json.dumps({'pid': os.getpid(), 'peak_rss_mb': peak_rss_mb(), 'stages': _stages}))
+        _dirty = False
+        _flushed = time.monotonic()
+
+
+def write_process_metrics(snapshot):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        f.write(snapshot)
+    os.replace(path + '.tmp', path)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def metrics_snapshot():
+    # Stage totals of every live process, files of processes that exited are removed
+    stages = {}
+    processes = []
+    names = os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            with open(path) as f:
+                process = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        if not process_alive(process['pid']):
+            # Another worker may have removed it first
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        processes.append({'pid': process['pid'], 'peak_rss_mb': process['peak_rss_mb']})
+        for stage_name, totals in process['stages'].items():
+            merged = stages.setdefault(stage_name, dict(totals, count=0, seconds_total=0.0, rows_in=0, rows_out=0))
+            merged['count'] += totals['count']
+            merged['seconds_total'] += totals['seconds_total']
+            merged['rows_in'] += totals['rows_in']
+            merged['rows_out'] += totals['rows_out']
+            merged['seconds_max'] = max(merged['seconds_max'], totals['seconds_max'])
+            merged['peak_rss_delta_mb_max'] = max(merged['peak_rss_delta_mb_max'], totals['peak_rss_delta_mb_max'])
+    for totals in stages.values():
+        totals['seconds_mean'] = totals['seconds_total'] / max(totals['count'], 1)
+    return {'processes': processes, 'stages': stages}
+
+
+def profile_requested():
+    return PROFILE_REQUESTS and (request.args.get('profile') or request.headers.get('X-Profile'))
+
+
+def register_metrics_routes(server):
+    # /metrics reports the stage totals, written after each request; with PROFILE_REQUESTS=1 a request can also
+    # ask to be profiled
+
+    @server.route('/metrics', methods=['GET'])
+    def metrics():
+        flush_metrics()
+        return jsonify(metrics_snapshot())
+
+    @server.teardown_request
+    def write_metrics(error=None):
+        flush_metrics()
+
+    @server.before_request
+    def start_profile():
+        mode = profile_requested()
+        if not mode:
+            return
+        if mode == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                Profiler = None
+            if Profiler is not None:
+                g.profiler = Profiler()
+                g.profiler.start()
+                return
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    @server.after_request
+    def save_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        directory = os.path.join(METRICS_DIR, 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{request.path.strip('/').replace('/', '_')[:60] or 'index'}"
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            path = os.path.join(directory, name + '.prof')
+            profiler.dump_stats(path)
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+            logger.info('Profile of %s saved to %s\n%s', request.path, path, summary.getvalue())
+        else:
+            profiler.stop()
+            path = os.path.join(directory, name + '.html')
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+            logger.info('Profile of %s saved to %s', request.path, path)
+        response.headers['X-Profile'] = path
+        return response
@@ -0,0 +1,47 @@
+import pandas as pd
+
+from data_processing import TIME_BINS, time_bins
+from reference_data import lookup_zones
+
+# One sparse matrix per label x mode x time bin, stored as its non-zero (origin, destination) cells
+OD_KEYS = ['label', 'mode', 'time_range', 'origin_taz', 'destination_taz']
+OD_VALUES = ['trips', 'travel_time', 'total_distance']
+
+
+def od_counts(df, time_bin=min(TIME_BINS)):
+    # Trips and summed travel time and distance per zone pair, at the finest bin so they can be re-binned.
+    # Only pairs with trips are kept, thousands of rows instead of one per trip.
+    trips = df[(df['origin_taz'] >= 0) & (df['destination_taz'] >= 0)]
+    return (
+        trips.assign(time_range=time_bins(trips['start_time'], time_bin))
+        .groupby(OD_KEYS, observed=True, sort=True)
+        .agg(trips=('start_time', 'size'), travel_time=('travel_time', 'sum'), total_distance=('total_distance', 'sum'))
+        .reset_index()
+    )
+
+
+def sum_od(frames, time_bin=None):
+    # Add up OD counts of chunks or partitions, re-binned to time_bin minutes when given
+    od = pd.concat(frames, ignore_index=True)
+    if time_bin is not None:
+        od['time_range'] = time_bins(od['time_range'], time_bin)
+    return od.groupby(OD_KEYS, observed=True, sort=True)[OD_VALUES].sum().reset_index()
+
+
+def od_flows(od, zone_index, by=('label',)):
+    # Zone-to-zone flows with the centroids of both zones, for flow maps and comparisons
+    flows = od.groupby(list(by) + ['origin_taz', 'destination_taz'], observed=True, sort=True)[OD_VALUES].sum().reset_index()
+    for end in ['origin', 'destination']:
+        positions, _ = lookup_zones(zone_index, flows[f'{end}_taz'])
+        flows[f'{end}_lat'] = zone_index.lat[positions]
+        flows[f'{end}_long'] = zone_index.lon[positions]
+    return flows
+
+
+def od_export(od):
+    # Flat table for download, with mean travel time and distance instead of the sums
+    export = od[OD_KEYS].copy()
+    export['trips'] = od['trips']
+    export['mean_travel_time'] = od['travel_time'] / od['trips']
+    export['mean_distance'] = od['total_distance'] / od['trips']
+    return export
@@ -0,0 +1,73 @@
+import logging
+import os
+
+import numpy as np
+
+from aggregation import add_cube_parts, cube_parts, parts_cube
+from data_processing import (
+    CATEGORICAL_COLUMNS, DEFAULT_TIME_BIN, compact_trip_table, enrich_trips, no_progress, read_subtrip_csv,
+    scenario_source, type_subtrips,
+)
+from od_matrix import od_counts, sum_od
+from reference_data import get_reference_data
+from scenario_store import STORE_FORMAT, save_cube, save_scenario_chunks, save_table
+
+logger = logging.getLogger(__name__)
+
+# Files at least this large (bytes) are processed in chunks of CHUNK_ROWS rows, 0 processes every file in chunks
+OUT_OF_CORE_BYTES = int(os.environ.get('OUT_OF_CORE_BYTES', 1024 ** 3))
+CHUNK_ROWS = int(os.environ.get('CHUNK_ROWS', 1000000))
+
+
+def source_size(content):
+    # Size of the CSV behind a data URL or a spooled path
+    if content.startswith('data:'):
+        return (len(content) - content.index(',') - 1) * 3 // 4
+    return os.path.getsize(content)
+
+
+def use_out_of_core(content):
+    # Chunks go straight into the Arrow store, so the pickle fallback always processes in memory
+    return STORE_FORMAT == 'arrow' and source_size(content) >= OUT_OF_CORE_BYTES
+
+
+def trip_chunks(content, label, time_bin=DEFAULT_TIME_BIN, chunk_rows=CHUNK_ROWS, progress=no_progress):
+    # The process_files pipeline (type, enrich, geo-join, compact) applied to one bounded chunk at a time
+    reference = get_reference_data()
+    # Person ids are bounded by the population table, so every chunk gets the same id type
+    person_type = np.int32 if reference.person_table.ids.max() <= np.iinfo(np.int32).max else np.int64
+    source = scenario_source(content)
+    handle = source if hasattr(source, 'read') else open(source, 'rb')
+    size = max(source_size(content), 1)
+    with handle:
+        for chunk in read_subtrip_csv(handle, chunksize=chunk_rows):
+            progress('parse', min(handle.tell() / size, 1.0))
+            df = compact_trip_table(enrich_trips(type_subtrips(chunk, label, time_bin), reference))
+            yield df.astype({'person_id': person_type})
+
+
+def process_out_of_core(key, content, label, time_bin=DEFAULT_TIME_BIN, chunk_rows=CHUNK_ROWS, progress=no_progress):
+    # Store a scenario, its count cube and OD counts without ever holding the whole file: chunks are appended to the
+    # scenario store and folded into the cube as they are produced, memory depends on chunk_rows only
+    parts = None
+    od = None
+    categories = {}
+
+    def stored_chunks():
+        nonlocal parts, od
+        for df in trip_chunks(content, label, time_bin, chunk_rows, progress):
+            parts = add_cube_parts(parts, cube_parts(df))
+            od = od_counts(df) if od is None else sum_od([od, od_counts(df)])
+            # Arrow files take growing dictionaries only, keep every category seen so far in its place
+            for column in CATEGORICAL_COLUMNS:
+                seen = categories.setdefault(column, [])
+                seen += [category for category in df[column].cat.categories if category not in seen]
+                df[column] = df[column].cat.set_categories(seen)
+            yield df
+
+    info = save_scenario_chunks(key, stored_chunks(), [label])
+    progress('aggregate')
+    save_cube(key, parts_cube(parts))
+    save_table(key, 'od', od)
+    logger.info('Processed %d trips of %s out of core in chunks of %d rows', info['rows'], label, chunk_rows)
+    return info
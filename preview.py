@@ -0,0 +1,77 @@
+import io
+import os
+
+import numpy as np
+
+from aggregation import count_cube
+from data_processing import combine_scenarios, enrich_trips, read_subtrip_csv, scenario_source, type_subtrips
+from maps import stratified_sample
+from metrics import instrumented
+from reference_data import get_reference_data
+from visualization import cube_view
+
+# Trips per scenario charted while the whole files are processed
+PREVIEW_ROWS = int(os.environ.get('PREVIEW_ROWS', 50000))
+# Evenly spaced slices of a file the sample is read from, so it covers the whole day and not only the first lines
+PREVIEW_BLOCKS = 64
+# Lines read per trip kept, the stratified sample then keeps every mode in its share
+OVERSAMPLE = 4
+
+
+def sample_csv(source, lines, blocks=PREVIEW_BLOCKS):
+    # Header and whole lines from evenly spaced blocks of a subtrip file (path or file handle), with the
+    # share of the file's lines they hold. Files not much larger than the sample are read whole.
+    f = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+        header = f.readline()
+        head = f.read(1 << 16)
+        line_bytes = len(head) / max(head.count(b'\n'), 1)
+        if size <= len(header) + 2 * lines * line_bytes:
+            return io.BytesIO(header + head + f.read()), 1.0
+        block_bytes = int(lines * line_bytes / blocks)
+        pieces = []
+        for offset in np.linspace(len(header), size - block_bytes, blocks).astype(np.int64):
+            f.seek(offset)
+            block = f.read(block_bytes)
+            # Blocks start and end in the middle of lines, only the lines between the first and last newline are kept
+            pieces.append(block[block.find(b'\n') + 1:block.rfind(b'\n') + 1])
+        sample = b''.join(pieces)
+        return io.BytesIO(header + sample), len(sample) / (size - len(header))
+    finally:
+        if f is not source:
+            f.close()
+
+
+def preview_trips(content, label, rows=PREVIEW_ROWS):
+    # At most rows trips of one scenario stratified by mode, and the share of the file's trips each one stands for
+    sample, fraction = sample_csv(scenario_source(content), rows * OVERSAMPLE)
+    df = type_subtrips(read_subtrip_csv(sample), label)
+    kept = stratified_sample(df, rows, strata=('label', 'mode'))
+    return kept, fraction * len(kept) / max(len(df), 1)
+
+
+def sample_title(labels, fractions):
+    shares = ', '.join(f'{label} {100 * fraction:.3g}%' for label, fraction in zip(labels, fractions))
+    return f'Preview from a sample of the trips ({shares}), counts are estimates until processing finishes'
+
+
+@instrumented('preview_cube')
+def preview_cube(contents, labels, rows=PREVIEW_ROWS):
+    # Histogram cube of a sample of every scenario with its counts scaled up to the whole files.
+    # None when every file fits in the sample, the exact cube follows about as fast.
+    frames, fractions = zip(*[preview_trips(content, label, rows) for content, label in zip(contents, labels)])
+    if min(fractions) >= 1:
+        return None
+    trips = enrich_trips(combine_scenarios(list(frames)), get_reference_data())
+    cube = count_cube(trips)
+    scales = [1 / dict(zip(labels, fractions))[label] for label in cube['labels']]
+    for data in cube['dimensions'].values():
+        data['count'] = [int(round(count * scales[code])) for count, code in zip(data['count'], data['label'])]
+
+    view = cube_view(cube)
+    view['layout']['title'] = {'text': sample_title(labels, fractions)}
+    view['sample_fractions'] = dict(zip(labels, fractions))
+    return view
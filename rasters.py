@@ -0,0 +1,112 @@
+import base64
+import os
+import struct
+import zlib
+
+import numpy as np
+import plotly.colors
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+from metrics import instrumented
+
+# Long side, in pixels, of every rendered density image, whatever the number of trips
+RASTER_PIXELS = int(os.environ.get('RASTER_PIXELS', 400))
+COLORSCALE = plotly.colors.sequential.Viridis
+
+# Trip ends that can be rasterized
+ENDS = ['origin', 'destination']
+
+
+def full_bounds(node_index, padding=0.02):
+    # West, south, east, north around every node, trips can only start and end on nodes
+    west, east = node_index.lon.min(), node_index.lon.max()
+    south, north = node_index.lat.min(), node_index.lat.max()
+    pad_x, pad_y = (east - west) * padding, (north - south) * padding
+    return float(west - pad_x), float(south - pad_y), float(east + pad_x), float(north + pad_y)
+
+
+def raster_shape(bounds, pixels=RASTER_PIXELS):
+    # Height and width with square ground pixels, a degree of longitude shrinks with cos(latitude)
+    west, south, east, north = bounds
+    ground_width = (east - west) * np.cos(np.radians((south + north) / 2))
+    ground_height = north - south
+    scale = pixels / max(ground_width, ground_height)
+    return max(int(round(ground_height * scale)), 1), max(int(round(ground_width * scale)), 1)
+
+
+def density_grid(lat, lon, bounds, shape):
+    # Trips per pixel, row 0 is the northern edge; points outside the viewport are dropped first
+    west, south, east, north = bounds
+    height, width = shape
+    inside = (lon >= west) & (lon < east) & (lat > south) & (lat <= north)
+    col = ((lon[inside] - west) * (width / (east - west))).astype(np.int64)
+    row = ((north - lat[inside]) * (height / (north - south))).astype(np.int64)
+    cells = np.minimum(row, height - 1) * width + np.minimum(col, width - 1)
+    return np.bincount(cells, minlength=height * width).reshape(height, width)
+
+
+def shade(grid, vmax=None):
+    # Log-scaled colors through the colorscale, empty pixels stay transparent
+    lut = np.array([plotly.colors.hex_to_rgb(color) for color in COLORSCALE], dtype=np.float64)
+    levels = np.log1p(grid)
+    vmax = vmax or levels.max() or 1
+    position = np.clip(levels / vmax, 0, 1) * (len(lut) - 1)
+    rgba = np.empty(grid.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(position, np.arange(len(lut)), lut[:, channel])
+    rgba[..., 3] = np.where(grid > 0, 230, 0)
+    return rgba
+
+
+def png_data_url(rgba):
+    # Minimal RGBA PNG encoder, one filter byte per row
+    height, width = rgba.shape[:2]
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    png = (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(raw, 6))
+        + chunk(b'IEND', b'')
+    )
+    return 'data:image/png;base64,' + base64.b64encode(png).decode()
+
+
+@instrumented('density_figure', payload=True)
+def density_figure(grids, labels, bounds, title):
+    # One facet per label with its density image stretched over the viewport, all facets zoom and pan together
+    west, south, east, north = bounds
+    fig = make_subplots(rows=1, cols=max(len(labels), 1), shared_xaxes=True, shared_yaxes=True,
+                        horizontal_spacing=0.02, column_titles=[str(label) for label in labels])
+    # Shared color range, so the same color means the same density in every facet
+    vmax = max((np.log1p(grid).max() for grid in grids), default=1)
+    for col, grid in enumerate(grids, start=1):
+        # Invisible corners give the axes their extent
+        fig.add_trace(go.Scatter(x=[west, east], y=[south, north], mode='markers', marker_opacity=0,
+                                 hoverinfo='skip', showlegend=False), row=1, col=col)
+        subplot = fig.get_subplot(1, col)
+        fig.add_layout_image(
+            source=png_data_url(shade(grid, vmax)),
+            xref=subplot.xaxis.plotly_name.replace('axis', ''), yref=subplot.yaxis.plotly_name.replace('axis', ''),
+            x=west, y=north, sizex=east - west, sizey=north - south,
+            sizing='stretch', layer='below',
+        )
+    fig.update_xaxes(range=[west, east], showgrid=False, title_text='Longitude')
+    fig.update_yaxes(range=[south, north], showgrid=False, scaleanchor='x', scaleratio=1 / np.cos(np.radians((south + north) / 2)))
+    fig.update_yaxes(title_text='Latitude', col=1)
+    fig.update_layout(title=title, height=600, plot_bgcolor='#111111')
+    return fig
+
+
+def relayout_bounds(relayout_data):
+    # Viewport after a zoom or pan, None when the view was reset or nothing changed
+    relayout_data = relayout_data or {}
+    x = [value for name, value in sorted(relayout_data.items()) if name.startswith('xaxis') and '.range[' in name]
+    y = [value for name, value in sorted(relayout_data.items()) if name.startswith('yaxis') and '.range[' in name]
+    if len(x) < 2 or len(y) < 2:
+        return None
+    return min(x[:2]), min(y[:2]), max(x[:2]), max(y[:2])
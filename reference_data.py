@@ -0,0 +1,225 @@
+import hashlib
+import os
+import threading
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from metrics import instrumented
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Reference tables used by process_files; their mtimes make up the reference-data version
+REFERENCE_FILES = {
+    'population': 'population/categories_vc.csv',
+    'gender': 'population/gender.csv',
+    'education': 'population/education.csv',
+    'vehicle': 'population/vehicle_category.csv',
+    'age': 'population/age.csv',
+    'income': 'population/income.csv',
+    'zones': 'shp_files/sm_zone.shp',
+    'nodes': 'shp_files/node.shp',
+}
+
+
+class NodeIndex(NamedTuple):
+    # Sorted node ids with contiguous WGS84 coordinates and their zone ids (-1 outside every zone) at the same positions
+    ids: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    zone: np.ndarray
+
+
+class ZoneIndex(NamedTuple):
+    # Sorted TAZ ids with the WGS84 coordinates of their centroids at the same positions
+    ids: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+
+
+class PersonTable(NamedTuple):
+    # Sorted person ids with their demographic attributes as categoricals in the same order
+    ids: np.ndarray
+    attributes: pd.DataFrame
+
+
+class ReferenceData(NamedTuple):
+    # Read-only snapshot shared by every callback in the process, never mutate the frames
+    version: str
+    population: pd.DataFrame
+    gender: pd.DataFrame
+    education: pd.DataFrame
+    vehicle: pd.DataFrame
+    age: pd.DataFrame
+    income: pd.DataFrame
+    zones: 'geopandas.GeoDataFrame'
+    nodes: 'geopandas.GeoDataFrame'
+    node_index: NodeIndex
+    zone_index: ZoneIndex
+    person_table: PersonTable
+
+
+def reference_path(name):
+    return os.path.join(DATA_DIR, REFERENCE_FILES[name])
+
+
+def reference_version():
+    # Fingerprint of the reference files, so cached results go stale when the data changes
+    digest = hashlib.sha1()
+    for name in REFERENCE_FILES:
+        path = reference_path(name)
+        try:
+            stat = os.stat(path)
+            digest.update(f'{name}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+        except FileNotFoundError:
+            digest.update(f'{name}:missing;'.encode())
+    return digest.hexdigest()
+
+
+def node_zones(nodes, zones):
+    # Zone of every node, found once through an STRtree over the zone polygons instead of a spatial join per upload
+    from shapely import STRtree
+    tree = STRtree(zones.geometry.values)
+    node_positions, zone_positions = tree.query(nodes.geometry.values, predicate='intersects')
+    zone = np.full(len(nodes), -1, dtype=np.int32)
+    # Reversed so a node on a shared border keeps the first zone it touches
+    zone[node_positions[::-1]] = pd.to_numeric(zones['zone_id']).to_numpy(np.int32)[zone_positions[::-1]]
+    return zone
+
+
+def build_node_index(nodes, zones):
+    ids = pd.to_numeric(nodes['id']).to_numpy(np.int64)
+    order = np.argsort(ids, kind='stable')
+    return NodeIndex(
+        ids=ids[order],
+        lat=np.ascontiguousarray(nodes.geometry.y.to_numpy()[order]),
+        lon=np.ascontiguousarray(nodes.geometry.x.to_numpy()[order]),
+        zone=node_zones(nodes, zones)[order],
+    )
+
+
+def build_zone_index(zones):
+    # Centroids are taken in the projected CRS of the shapefile and only then converted to WGS84
+    ids = pd.to_numeric(zones['zone_id']).to_numpy(np.int64)
+    order = np.argsort(ids, kind='stable')
+    centroids = zones.geometry.centroid.to_crs(epsg=4326)
+    return ZoneIndex(
+        ids=ids[order],
+        lat=np.ascontiguousarray(centroids.y.to_numpy()[order]),
+        lon=np.ascontiguousarray(centroids.x.to_numpy()[order]),
+    )
+
+
+def lookup_positions(sorted_ids, ids):
+    # Vectorized id -> position lookup, returns positions and a mask of the ids that exist
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.intp), np.zeros(len(ids), dtype=bool)
+    positions = np.searchsorted(sorted_ids, ids)
+    positions = np.minimum(positions, len(sorted_ids) - 1)
+    found = sorted_ids[positions] == ids
+    return positions, found
+
+
+def lookup_nodes(node_index, node_ids):
+    return lookup_positions(node_index.ids, node_ids)
+
+
+def lookup_zones(zone_index, zone_ids):
+    return lookup_positions(zone_index.ids, zone_ids)
+
+
+def decode_category(codes, table, key, name):
+    # Translate id codes through a lookup table, returning a categorical and a mask of known codes
+    positions = pd.Index(table[key]).get_indexer(codes)
+    found = positions >= 0
+    values = table[name].to_numpy()[np.where(found, positions, 0)]
+    return pd.Categorical(values, categories=pd.unique(table[name])), found
+
+
+def income_ranges(incomes, income):
+    # Same bins as pd.cut(right=False) over the low limits, found with searchsorted
+    income = income.sort_values('low_limit')
+    limits = income['low_limit'].to_numpy(dtype=float)
+    codes = np.searchsorted(limits, np.asarray(incomes, dtype=float), side='right') - 1
+    codes[np.isnan(incomes)] = -1
+    return pd.Categorical.from_codes(codes, categories=pd.Index(income['income_range']), ordered=True)
+
+
+def build_person_table(population, gender, education, vehicle, age, income):
+    # Decode every person's attributes once, persons with unknown codes are left out like the inner merges did
+    attributes = {}
+    known = np.ones(len(population), dtype=bool)
+    for table, key, name in [
+        (gender, 'gender_id', 'gender'),
+        (education, 'education_type_id', 'education_category'),
+        (vehicle, 'vehicle_category_id', 'vehicle_name'),
+        (age, 'age_category_id', 'age'),
+    ]:
+        attributes[name], found = decode_category(population[key], table, key, name)
+        known &= found
+    attributes['range_income'] = income_ranges(population['income'].to_numpy(dtype=float), income)
+
+    ids = population['person_id'].to_numpy(np.int64)[known]
+    order = np.argsort(ids, kind='stable')
+    attributes = pd.DataFrame(attributes)[known].iloc[order].reset_index(drop=True)
+    return PersonTable(ids=ids[order], attributes=attributes)
+
+
+def lookup_persons(person_table, person_ids):
+    return lookup_positions(person_table.ids, person_ids)
+
+
+@instrumented('reference')
+def load_reference_data(version=None):
+    # Read, rename and reproject every reference table once
+    population = pd.read_csv(reference_path('population'), delimiter=',').rename(columns={"id": "person_id"})
+    gender = pd.read_csv(reference_path('gender'), delimiter=',').rename(columns={"id": "gender_id", "name": "gender"})
+    education = pd.read_csv(reference_path('education'), delimiter=',').rename(columns={"id": "education_type_id", "name": "education_category"})
+    vehicle = pd.read_csv(reference_path('vehicle'), delimiter=',').rename(columns={"id": "vehicle_category_id", "name": "vehicle_name"})
+    age = pd.read_csv(reference_path('age'), delimiter=',').rename(columns={"id": "age_category_id", "name": "age"})
+    income = pd.read_csv(reference_path('income'), delimiter=',').rename(columns={"id": "income_id", "name": "income_range"})
+
+    # geopandas is imported here, only the process loading the shapefiles pays for it
+    import geopandas as gpd
+
+    projected_zones = gpd.read_file(reference_path('zones'))
+    zones = projected_zones.to_crs(epsg=4326)
+    nodes = gpd.read_file(reference_path('nodes')).to_crs(epsg=4326)
+
+    return ReferenceData(
+        version=version or reference_version(),
+        population=population,
+        gender=gender,
+        education=education,
+        vehicle=vehicle,
+        age=age,
+        income=income,
+        zones=zones,
+        nodes=nodes,
+        node_index=build_node_index(nodes, zones),
+        zone_index=build_zone_index(projected_zones),
+        person_table=build_person_table(population, gender, education, vehicle, age, income),
+    )
+
+
+_reference = None
+_reference_lock = threading.Lock()
+
+
+def reference_loaded():
+    # True once this process holds the current reference data, e.g. inherited from a preloading gunicorn master
+    return _reference is not None and _reference.version == reference_version()
+
+
+def get_reference_data():
+    # Process-wide registry, reloaded only when a reference file's mtime changes
+    global _reference
+    version = reference_version()
+    if _reference is not None and _reference.version == version:
+        return _reference
+    with _reference_lock:
+        if _reference is None or _reference.version != version:
+            _reference = load_reference_data(version)
+        return _reference
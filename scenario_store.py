@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Processed datasets are kept next to the app, keyed by their dataset key
+STORE_DIR = os.environ.get('STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'scenarios'))
+
+# Arrow IPC files can be memory-mapped and read column by column, pickles are the fallback without pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    STORE_FORMAT = 'arrow'
+except ImportError:
+    STORE_FORMAT = 'pickle'
+
+
+def store_path(key, suffix):
+    return os.path.join(STORE_DIR, key + suffix)
+
+
+def data_path(key):
+    return store_path(key, '.arrow' if STORE_FORMAT == 'arrow' else '.pkl')
+
+
+@contextmanager
+def replacing(path):
+    # Unique temporary file next to path, renamed into place when the block succeeds and removed when it fails,
+    # so processes writing the same key never write into each other's file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_arrow(df, path):
+    # Uncompressed and in a single record batch, so reading it back can map the columns instead of copying them
+    feather.write_feather(df.reset_index(drop=True), path, compression='uncompressed', chunksize=max(len(df), 1))
+
+
+def read_arrow(path, columns=None):
+    # Columns without nulls of a single-batch file come out as read-only views of the memory map, every worker
+    # reading the file shares its pages in the page cache. Files written in several batches (out of core) are copied.
+    return feather.read_table(path, columns=columns, memory_map=True).to_pandas(split_blocks=True)
+
+
+def has_scenario(key):
+    return os.path.exists(store_path(key, '.json')) and os.path.exists(data_path(key))
+
+
+def save_scenario(key, df, filenames=None):
+    # Write the data first and the metadata last, the metadata file marks the entry as complete
+    os.makedirs(STORE_DIR, exist_ok=True)
+    with replacing(data_path(key)) as tmp:
+        if STORE_FORMAT == 'arrow':
+            write_arrow(df, tmp)
+        else:
+            df.to_pickle(tmp)
+
+    labels = df['label'].cat.categories if isinstance(df['label'].dtype, pd.CategoricalDtype) else pd.unique(df['label'])
+    return write_info(key, labels, len(df), filenames)
+
+
+def save_scenario_chunks(key, chunks, filenames=None):
+    # Append frames with one schema to the Arrow file as they come, the scenario is never in memory as a whole.
+    # Categories may only grow between chunks, new ones are written as dictionary deltas.
+    os.makedirs(STORE_DIR, exist_ok=True)
+    writer = None
+    labels = {}
+    rows = 0
+    # A cancelled or failed job leaves no partial file behind, it can be gigabytes
+    with replacing(data_path(key)) as tmp:
+        try:
+            for df in chunks:
+                table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+                if writer is None:
+                    writer = pa.ipc.new_file(tmp, table.schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+                writer.write_table(table)
+                labels.update(dict.fromkeys(df['label'].cat.categories))
+                rows += len(df)
+            if writer is None:
+                raise ValueError(f'No rows to store for {key}')
+        finally:
+            if writer is not None:
+                writer.close()
+    return write_info(key, list(labels), rows, filenames)
+
+
+def write_info(key, labels, rows, filenames=None):
+    info = {
+        'key': key,
+        'filenames': list(filenames or []),
+        'labels': [str(label) for label in labels],
+        'rows': rows,
+        'created': time.time(),
+    }
+    with replacing(store_path(key, '.json')) as tmp, open(tmp, 'w') as f:
+        json.dump(info, f)
+    return info
+
+
+def open_scenario(key, columns=None):
+    # Reopen a stored dataset, reading only the requested columns
+    if not has_scenario(key):
+        return None
+    if STORE_FORMAT == 'arrow':
+        return read_arrow(data_path(key), columns)
+    df = pd.read_pickle(data_path(key))
+    return df if columns is None else df[columns]
+
+
+def scenario_batches(key, columns=None):
+    # A stored dataset as frames of its record batches, so a scenario larger than memory can be scanned.
+    # Requested columns the dataset does not have are left out, an empty dataset is one empty frame.
+    if STORE_FORMAT == 'arrow':
+        with pa.memory_map(data_path(key)) as source:
+            reader = pa.ipc.open_file(source)
+            names = [name for name in columns if name in reader.schema.names] if columns is not None else None
+            if reader.num_record_batches == 0:
+                schema = reader.schema if names is None else pa.schema([reader.schema.field(name) for name in names])
+                yield schema.empty_table().to_pandas()
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield (batch if names is None else batch.select(names)).to_pandas()
+    else:
+        df = open_scenario(key)
+        yield df if columns is None else df[[name for name in columns if name in df]]
+
+
+def save_cube(key, cube):
+    # Count cube of a stored scenario, kept so other workers do not have to recount it
+    with replacing(store_path(key, '.cube.json')) as tmp, open(tmp, 'w') as f:
+        json.dump(cube, f)
+
+
+def open_cube(key):
+    try:
+        with open(store_path(key, '.cube.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def table_path(key, name):
+    return store_path(key, f'.{name}.arrow' if STORE_FORMAT == 'arrow' else f'.{name}.pkl')
+
+
+def save_table(key, name, df):
+    # Small derived table of a stored scenario (e.g. its OD counts), kept so other workers do not recompute it
+    with replacing(table_path(key, name)) as tmp:
+        if STORE_FORMAT == 'arrow':
+            write_arrow(df, tmp)
+        else:
+            df.to_pickle(tmp)
+
+
+def open_table(key, name):
+    path = table_path(key, name)
+    if not os.path.exists(path):
+        return None
+    if STORE_FORMAT == 'arrow':
+        return read_arrow(path)
+    return pd.read_pickle(path)
+
+
+def scenario_info(key):
+    try:
+        with open(store_path(key, '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_scenarios():
+    # Metadata of every stored dataset, newest first
+    if not os.path.isdir(STORE_DIR):
+        return []
+    scenarios = []
+    for name in os.listdir(STORE_DIR):
+        if name.endswith('.json') and not name.endswith('.cube.json'):
+            with open(os.path.join(STORE_DIR, name)) as f:
+                scenarios.append(json.load(f))
+    return sorted(scenarios, key=lambda info: info['created'], reverse=True)
+
@@ -0,0 +1,14 @@
+import pytest
+
+from benchmarks.workload import prepare_reference_data, write_scenario
+
+
+@pytest.fixture(scope='session')
+def reference_dir(tmp_path_factory):
+    # Reference data with a synthetic population table, which is not part of the repository
+    return prepare_reference_data(str(tmp_path_factory.mktemp('data')), persons=2000)
+
+
+@pytest.fixture(scope='session')
+def subtrip_file(reference_dir, tmp_path_factory):
+    return write_scenario(str(tmp_path_factory.mktemp('subtrips') / 'subtrips.csv'), rows=3000, seed=0)
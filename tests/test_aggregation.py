@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from aggregation import (
+    BOX_COLUMNS, COLOR_DIMENSIONS, TOTAL, count_cube, cube_boxes, cube_counts, merge_cubes, time_box_stats,
+)
+
+
+def empty_trips():
+    # What enrichment returns when it drops every trip, e.g. a population file that matches no person
+    columns = {column: pd.Series([], dtype='category') for column in COLOR_DIMENSIONS + ['label']}
+    return pd.DataFrame(columns).assign(start_time=np.array([], dtype=np.int32))
+
+
+def test_time_box_stats_of_empty_frame():
+    stats = time_box_stats(empty_trips(), 'mode')
+    assert stats.empty
+    assert list(stats.columns) == BOX_COLUMNS
+
+
+def test_count_cube_of_empty_frame():
+    cube = count_cube(empty_trips())
+    assert cube['labels'] == []
+    for dimension in COLOR_DIMENSIONS:
+        assert cube['dimensions'][dimension]['count'] == []
+        assert cube['dimensions'][dimension]['boxes']['median'] == []
+
+
+def scenario_trips(label, rows, seed):
+    rng = np.random.default_rng(seed)
+    columns = {
+        dimension: pd.Categorical(rng.choice([f'{dimension} {i}' for i in range(3)], rows))
+        for dimension in COLOR_DIMENSIONS if dimension != TOTAL
+    }
+    return pd.DataFrame(columns).assign(
+        label=pd.Categorical([label] * rows),
+        start_time=rng.integers(0, 26 * 3600, rows).astype(np.int32),
+    )
+
+
+def cube_tables(cube):
+    # Counts and box statistics of every dimension in a fixed order, group codes may differ between cubes
+    tables = {}
+    for dimension in cube['dimensions']:
+        counts = cube_counts(cube, dimension)
+        boxes = cube_boxes(cube, dimension)
+        tables[dimension] = (
+            counts.sort_values(['label', 'time_range', 'color']).reset_index(drop=True),
+            boxes[sorted(boxes.columns)].sort_values(['label', 'color']).reset_index(drop=True),
+        )
+    return tables
+
+
+def assert_same_cube(actual, expected):
+    assert actual['labels'] == expected['labels']
+    actual, expected = cube_tables(actual), cube_tables(expected)
+    assert actual.keys() == expected.keys()
+    for dimension in expected:
+        pd.testing.assert_frame_equal(actual[dimension][0], expected[dimension][0], check_dtype=False)
+        pd.testing.assert_frame_equal(actual[dimension][1], expected[dimension][1], check_dtype=False)
+
+
+def test_merge_cubes_adding_and_removing_partitions():
+    frames = [scenario_trips(label, 500, seed) for seed, label in enumerate(['a', 'b', 'c'])]
+    cubes = [count_cube(df) for df in frames]
+
+    def from_scratch(dfs):
+        return count_cube(pd.concat(dfs, ignore_index=True))
+
+    assert_same_cube(merge_cubes(cubes[:2]), from_scratch(frames[:2]))
+    # Adding a partition merges one more cube, removing one merges the others again
+    assert_same_cube(merge_cubes([merge_cubes(cubes[:2]), cubes[2]]), from_scratch(frames))
+    assert_same_cube(merge_cubes([cubes[0], cubes[2]]), from_scratch([frames[0], frames[2]]))
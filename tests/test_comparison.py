@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from comparison import deltas, summary_table
+
+
+def test_deltas_against_baseline():
+    table = pd.DataFrame({
+        'label': ['base', 'base', 'new', 'new', 'new'],
+        'mode': ['Car', 'Walk', 'Car', 'Car', 'Bus'],
+        'trips': [10, 4, 6, 9, 3],
+    })
+    long = deltas(table, ['mode'], 'trips', 'base', ['base', 'new'])
+    rows = {(row.label, row.mode): row for row in long.itertuples()}
+
+    # Keys missing from a label count as zero, the same keys are summed
+    assert rows['new', 'Car'].trips == 15
+    assert rows['new', 'Car'].delta == 5
+    assert rows['new', 'Car'].change == 50
+    assert rows['new', 'Walk'].trips == 0
+    assert rows['new', 'Walk'].change == -100
+    assert rows['new', 'Bus'].delta == 3
+    assert np.isnan(rows['new', 'Bus'].change)
+    assert (long[long['label'] == 'base']['delta'] == 0).all()
+
+
+def test_summary_table_changes():
+    summary = pd.DataFrame({
+        'label': ['new', 'base'],
+        'trips': [150, 100],
+        'travel_time_mean': [0.5, 0.25],
+        'travel_time_p10': [0.1, 0.1],
+        'travel_time_p50': [0.5, 0.25],
+        'travel_time_p90': [1.0, 0.5],
+        'total_distance_mean': [12.0, 10.0],
+        'total_distance_p10': [1.0, 1.0],
+        'total_distance_p50': [9.0, 10.0],
+        'total_distance_p90': [30.0, 20.0],
+        'vkt': [1800.0, 1000.0],
+    })
+    table = summary_table({'labels': ['base', 'new'], 'summary': summary}, 'base').set_index('Scenario')
+
+    # Baseline values plain, travel times in minutes, every other label with its change in percent
+    assert table.loc['base', 'Trips'] == '100'
+    assert table.loc['base', 'Travel time mean (min)'] == '15.0'
+    assert table.loc['new', 'Trips'] == '150 (+50.0%)'
+    assert table.loc['new', 'Travel time mean (min)'] == '30.0 (+100.0%)'
+    assert table.loc['new', 'Travel time p10 (min)'] == '6.0 (+0.0%)'
+    assert table.loc['new', 'Distance p50 (km)'] == '9.0 (-10.0%)'
+    assert table.loc['new', 'Kilometres travelled'] == '1,800 (+80.0%)'
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from data_processing import attach_node_coordinates, parse_time_seconds
+from reference_data import NodeIndex, ZoneIndex
+
+
+def test_parse_time_seconds_of_header_only_file():
+    seconds = parse_time_seconds(pd.Series([], dtype=object))
+    assert seconds.dtype == np.int32
+    assert len(seconds) == 0
+
+
+def test_parse_time_seconds_past_midnight():
+    seconds = parse_time_seconds(pd.Series(['01:00:00', '25:00:01', '7:30:00']))
+    assert seconds.tolist() == [3600, 90001, 27000]
+
+
+def node_index():
+    return NodeIndex(
+        ids=np.array([10, 20, 30]), lat=np.array([1.1, 1.2, 1.3]), lon=np.array([103.1, 103.2, 103.3]),
+        zone=np.array([1, 2, -1]),
+    )
+
+
+def test_attach_node_coordinates():
+    trips = pd.DataFrame({'origin_node': ['30', '10'], 'destination_node': ['20', '30']})
+    df = attach_node_coordinates(trips, node_index())
+    assert df['origin_lat'].tolist() == [1.3, 1.1]
+    assert df['destination_long'].tolist() == [103.2, 103.3]
+    assert df.attrs['unmatched_trips'] == 0
+
+
+def test_attach_node_coordinates_drops_unmatched_nodes():
+    trips = pd.DataFrame({
+        'origin_node': ['10', '99', '20', 'x'],
+        'destination_node': ['20', '10', '404', '30'],
+        'origin_taz': [5.0, np.nan, 7.0, 8.0],
+        'destination_taz': [np.nan, 6.0, 9.0, 1.0],
+    })
+    zones = ZoneIndex(ids=np.array([1, 2, 5]), lat=np.zeros(3), lon=np.zeros(3))
+    df = attach_node_coordinates(trips, node_index(), zones)
+    assert df.index.tolist() == [0]
+    assert df.attrs['unmatched_trips'] == 3
+    # The file's TAZ where it is a known zone, the node's zone otherwise
+    assert df['origin_taz'].tolist() == [5]
+    assert df['destination_taz'].tolist() == [2]
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from maps import draw_sample, sample_candidates, stratified_sample
+
+
+def trips(rows=1000):
+    # Every tenth trip has an unknown mode
+    mode = np.where(np.arange(rows) % 10 == 0, None, np.where(np.arange(rows) % 2 == 0, 'Car', 'Walk'))
+    return pd.DataFrame({'label': pd.Categorical(['a'] * rows), 'mode': pd.Categorical(mode), 'trip': np.arange(rows)})
+
+
+def test_stratified_sample_with_missing_strata():
+    sample = stratified_sample(trips(), 100)
+    assert len(sample) == 100
+    assert sample['mode'].isna().sum() == 10
+    assert sample['trip'].is_unique
+
+
+def test_draw_sample_with_missing_strata():
+    df = trips()
+    sizes = df.groupby(['label', 'mode'], observed=True, dropna=False).size()
+    sample = draw_sample(sample_candidates(df, 100), sizes, 100)
+    assert len(sample) == 100
+    assert sample['mode'].isna().sum() == 10
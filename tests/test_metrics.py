@@ -0,0 +1,34 @@
+import multiprocessing
+
+import metrics
+from metrics import flush_metrics, metrics_snapshot, stage
+
+
+def child_stage(recorded, done):
+    with stage('child'):
+        pass
+    flush_metrics()
+    recorded.set()
+    # Stay alive until the parent has read the snapshot, files of exited processes are dropped
+    done.wait(10)
+
+
+def test_forked_process_does_not_repeat_parent_stages(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    for _ in range(5):
+        with stage('parent'):
+            pass
+    flush_metrics()
+
+    context = multiprocessing.get_context('fork')
+    recorded, done = context.Event(), context.Event()
+    child = context.Process(target=child_stage, args=(recorded, done))
+    child.start()
+    try:
+        assert recorded.wait(10)
+        stages = metrics_snapshot()['stages']
+    finally:
+        done.set()
+        child.join()
+    assert stages['parent']['count'] == 5
+    assert stages['child']['count'] == 1
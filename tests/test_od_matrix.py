@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from od_matrix import od_counts, sum_od
+
+
+def trips():
+    return pd.DataFrame({
+        'label': pd.Categorical(['a', 'a', 'a', 'a', 'b']),
+        'mode': pd.Categorical(['Car', 'Car', 'Car', 'Walk', 'Car']),
+        'start_time': np.array([0, 299, 300, 100, 3600], dtype=np.int32),
+        'origin_taz': [1, 1, 1, 1, -1],
+        'destination_taz': [2, 2, 2, 3, 2],
+        'travel_time': [0.5, 0.25, 1.0, 0.1, 2.0],
+        'total_distance': [10.0, 5.0, 20.0, 1.0, 50.0],
+    })
+
+
+def test_od_counts_at_the_finest_bin():
+    od = od_counts(trips())
+    # The trip outside every zone is left out, pairs with trips only
+    assert od[['mode', 'time_range', 'origin_taz', 'destination_taz', 'trips']].astype(str).values.tolist() == [
+        ['Car', '0', '1', '2', '2'],
+        ['Car', '300', '1', '2', '1'],
+        ['Walk', '0', '1', '3', '1'],
+    ]
+    assert od['travel_time'].tolist() == [0.75, 1.0, 0.1]
+
+
+def test_sum_od_rebinned():
+    df = trips()
+    od = sum_od([od_counts(df.iloc[:2]), od_counts(df.iloc[2:])], time_bin=30)
+    assert od['time_range'].tolist() == [0, 0]
+    assert od['trips'].tolist() == [3, 1]
+    assert od['total_distance'].tolist() == [35.0, 1.0]
+    # Summing the chunks re-binned is re-binning the whole table
+    pd.testing.assert_frame_equal(od, sum_od([od_counts(df)], time_bin=30))
@@ -0,0 +1,28 @@
+import json
+
+import pandas as pd
+import plotly
+
+import scenario_store
+from aggregation import count_cube
+from benchmarks.out_of_core_parity import cube_differences, frame_differences
+from data_processing import process_files
+from od_matrix import od_counts
+from out_of_core import process_out_of_core
+
+
+def plain(df):
+    # Categories of the two engines may be in another order, compare their values
+    return df.astype({column: str for column in df.select_dtypes('category')})
+
+
+def test_out_of_core_matches_in_memory(subtrip_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(scenario_store, 'STORE_DIR', str(tmp_path))
+    expected = process_files([subtrip_file], compact=True, labels=['scenario'])
+    # Small chunks, so categories grow between chunks and the cube and OD counts are summed over several
+    process_out_of_core('parity', subtrip_file, 'scenario', chunk_rows=700)
+
+    assert frame_differences(expected, scenario_store.open_scenario('parity')) == []
+    expected_cube = json.loads(json.dumps(count_cube(expected), cls=plotly.utils.PlotlyJSONEncoder))
+    assert cube_differences(expected_cube, scenario_store.open_cube('parity')) == []
+    pd.testing.assert_frame_equal(plain(od_counts(expected)), plain(scenario_store.open_table('parity', 'od')))
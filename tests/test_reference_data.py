@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from reference_data import income_ranges, lookup_positions
+
+
+def test_lookup_positions():
+    positions, found = lookup_positions(np.array([3, 7, 10]), [7, 3, 5, 10, 11, -1])
+    assert found.tolist() == [True, True, False, True, False, False]
+    assert positions[found].tolist() == [1, 0, 2]
+
+
+def test_lookup_positions_in_empty_index():
+    positions, found = lookup_positions(np.array([], dtype=np.int64), [1, 2])
+    assert not found.any()
+    assert len(positions) == 2
+
+
+def test_income_ranges_match_pd_cut():
+    income = pd.DataFrame({
+        'low_limit': [1000, 0, 3000, 1500],
+        'income_range': ['$1000-$1499', 'below $1000', '$3000 and above', '$1500-$2999'],
+    })
+    # Every band edge, values just around them, one below the lowest limit and a missing income
+    incomes = np.array([0, 999.5, 1000, 1499.99, 1500, 2999, 3000, 1e6, -1, np.nan])
+    ranges = income_ranges(incomes, income)
+
+    ordered = income.sort_values('low_limit')
+    expected = pd.cut(incomes, bins=list(ordered['low_limit']) + [np.inf], right=False, labels=list(ordered['income_range']))
+    assert list(ranges.categories) == list(expected.categories)
+    assert ranges.codes.tolist() == expected.codes.tolist()
+    assert ranges.ordered
@@ -0,0 +1,60 @@
+import pytest
+from flask import Flask
+
+import uploads
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, 'SPOOL_DIR', str(tmp_path / 'spool'))
+    server = Flask(__name__)
+    uploads.register_upload_routes(server)
+    return server.test_client()
+
+
+def test_chunks_append_in_order(client):
+    assert client.post('/upload/0123abcd-1/chunk?offset=0', data=b'abc').get_json() == {'size': 3}
+    assert client.post('/upload/0123abcd-1/chunk?offset=3', data=b'de').get_json() == {'size': 5}
+    assert client.get('/upload/0123abcd-1').get_json() == {'size': 5, 'complete': False}
+
+
+def test_offset_mismatch_returns_current_size(client):
+    client.post('/upload/0123abcd-1/chunk?offset=0', data=b'abc')
+    response = client.post('/upload/0123abcd-1/chunk?offset=1', data=b'xyz')
+    assert response.status_code == 409
+    assert response.get_json() == {'size': 3}
+
+
+def test_oversized_chunk_is_refused(client, monkeypatch):
+    monkeypatch.setattr(uploads, 'MAX_CHUNK_BYTES', 4)
+    client.post('/upload/0123abcd-1/chunk?offset=0', data=b'abc')
+    response = client.post('/upload/0123abcd-1/chunk?offset=3', data=b'defgh')
+    assert response.status_code == 400
+    # Nothing of the refused chunk is kept
+    assert client.get('/upload/0123abcd-1').get_json()['size'] == 3
+
+
+def test_full_spool_is_refused(client, monkeypatch):
+    monkeypatch.setattr(uploads, 'SPOOL_MAX_BYTES', 4)
+    assert client.post('/upload/0123abcd-1/chunk?offset=0', data=b'abcdef').status_code == 413
+
+
+@pytest.mark.parametrize('upload_id', ['../etc', 'ABCDEFGH', 'short', 'a' * 65])
+def test_invalid_upload_id_is_rejected(client, upload_id):
+    assert client.post(f'/upload/{upload_id}/chunk?offset=0', data=b'abc').status_code in (400, 404)
+    with pytest.raises(uploads.UploadError):
+        uploads.spool_path(upload_id)
+
+
+def test_spooled_file_is_removed_once_stored(client, subtrip_file, tmp_path, monkeypatch):
+    import jobs
+    import scenario_store
+    monkeypatch.setattr(scenario_store, 'STORE_DIR', str(tmp_path / 'store'))
+    with open(subtrip_file, 'rb') as f:
+        client.post('/upload/0123abcd-1/chunk?offset=0', data=f.read())
+    assert client.post('/upload/0123abcd-1/complete', json={'filename': 'subtrips.csv'}).status_code == 200
+
+    sources, names = uploads.upload_sources([], [], [{'id': '0123abcd-1', 'filename': 'subtrips.csv'}])
+    key = jobs.process_partition(sources[0], 'subtrips')
+    assert scenario_store.has_scenario(key)
+    assert uploads.spool_files() == []
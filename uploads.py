@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from flask import jsonify, request
+
+from scenario_store import replacing
+
+# Chunked uploads are streamed to this directory instead of going through dcc.Upload contents
+SPOOL_DIR = os.environ.get('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'dash_mobility_uploads'))
+MAX_CHUNK_BYTES = 16 * 1024 ** 2
+READ_BYTES = 1024 ** 2
+# Spooled files are removed once they are stored as a partition, files nobody touches for SPOOL_TTL seconds
+# (abandoned or never processed uploads) are pruned, and the spool has a size limit
+SPOOL_TTL = 24 * 3600
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 20 * 1024 ** 3))
+
+UPLOAD_ID = re.compile(r'^[0-9a-f-]{8,64}$')
+
+
+class UploadError(ValueError):
+    pass
+
+
+class SpoolFull(UploadError):
+    pass
+
+
+def spool_path(upload_id, suffix='.csv'):
+    # Upload ids come from the browser, only accept plain ids so they cannot point outside the spool
+    if not UPLOAD_ID.match(upload_id or ''):
+        raise UploadError(f'Invalid upload id: {upload_id!r}')
+    return os.path.join(SPOOL_DIR, upload_id + suffix)
+
+
+def upload_info(upload_id):
+    try:
+        with open(spool_path(upload_id, '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def is_spooled(path):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(SPOOL_DIR)
+
+
+def file_digest(path):
+    # Content hash of a spooled file, computed once when the upload completes
+    if is_spooled(path):
+        info = upload_info(os.path.splitext(os.path.basename(path))[0])
+        if info and 'sha1' in info:
+            return info['sha1']
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BYTES), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def spool_files():
+    # (modified time, size, path) of every file in the spool
+    files = []
+    names = os.listdir(SPOOL_DIR) if os.path.isdir(SPOOL_DIR) else []
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def prune_spool(max_age=SPOOL_TTL):
+    # Drop uploads nobody has touched for a while, abandoned before they were completed or processed
+    cutoff = time.time() - max_age
+    for modified, _, path in spool_files():
+        if modified < cutoff:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def append_chunk(upload_id, offset, stream, length=None):
+    # Append one chunk at the given offset, reading the request body in bounded blocks
+    path = spool_path(upload_id)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset != size:
+        return size, False
+    if offset == 0:
+        prune_spool()
+    if sum(size for _, size, _ in spool_files()) + (length or 0) > SPOOL_MAX_BYTES:
+        raise SpoolFull(f'The upload spool is full ({SPOOL_MAX_BYTES} bytes), try again once other uploads are processed')
+    written = 0
+    with open(path, 'ab') as f:
+        for block in iter(lambda: stream.read(READ_BYTES), b''):
+            written += len(block)
+            if written > MAX_CHUNK_BYTES:
+                f.truncate(size)
+                raise UploadError(f'Chunks are limited to {MAX_CHUNK_BYTES} bytes')
+            f.write(block)
+    return size + written, True
+
+
+def complete_upload(upload_id, filename):
+    path = spool_path(upload_id)
+    if not os.path.exists(path):
+        raise UploadError(f'Nothing uploaded for {upload_id}')
+    info = {'filename': filename, 'size': os.path.getsize(path), 'sha1': file_digest(path)}
+    # Renamed into place, upload_info never reads half a file
+    with replacing(spool_path(upload_id, '.json')) as tmp, open(tmp, 'w') as f:
+        json.dump(info, f)
+    return info
+
+
+def remove_upload(source):
+    # A spooled file and its metadata, once the partition made from it is stored
+    if source.startswith('data:') or not is_spooled(source):
+        return
+    for path in (source, os.path.splitext(source)[0] + '.json'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def upload_sources(contents, filenames, spooled):
+    # Processing inputs and their file names: dcc.Upload data URLs followed by the paths of completed
+    # chunked uploads. Incomplete uploads are skipped together with their names, so labels stay aligned.
+    sources, names = list(contents or []), list(filenames or [])
+    for upload in spooled or []:
+        if upload_info(upload['id']) is not None:
+            sources.append(spool_path(upload['id']))
+            names.append(upload['filename'])
+    return sources, names
+
+
+def register_upload_routes(server):
+    # GET reports how much of an upload arrived (to resume), POST appends a chunk or completes it
+
+    @server.route('/upload/<upload_id>', methods=['GET'])
+    def upload_status(upload_id):
+        try:
+            path = spool_path(upload_id)
+        except UploadError as error:
+            return jsonify(error=str(error)), 400
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        return jsonify(size=size, complete=upload_info(upload_id) is not None)
+
+    @server.route('/upload/<upload_id>/chunk', methods=['POST'])
+    def upload_chunk(upload_id):
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        try:
+            size, accepted = append_chunk(upload_id, int(request.args.get('offset', 0)), request.stream, request.content_length)
+        except SpoolFull as error:
+            return jsonify(error=str(error)), 413
+        except UploadError as error:
+            return jsonify(error=str(error)), 400
+        # A mismatched offset answers with the current size so the client can resume from there
+        return jsonify(size=size), 200 if accepted else 409
+
+    @server.route('/upload/<upload_id>/complete', methods=['POST'])
+    def upload_complete(upload_id):
+        try:
+            info = complete_upload(upload_id, (request.get_json(silent=True) or {}).get('filename', upload_id))
+        except UploadError as error:
+            return jsonify(error=str(error)), 400
+        return jsonify(info)
@@ -1,59 +1,136 @@
-import numpy as np
-import plotly.express as px
-import pandas as pd
+import plotly.colors
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 
-def create_histogram_plot(combined_data, color_value):
-    
-    
-    
-    x_max = np.max(combined_data['time_range'])
-            
-    fig = px.histogram(combined_data, 
-                       facet_col='label',
-                       title="Distribution of Trips Across Scenarios",
-                       x="time_range", 
-                       color=color_value,
-                       marginal="box",
-                       nbins=20)
-            
-    fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+from aggregation import (TOTAL, cube_boxes, cube_counts, percent_of_bin,
+                         time_box_stats, time_counts)
+from data_processing import DEFAULT_TIME_BIN
+from metrics import instrumented
+
+# Shaded periods of the day, in hours since midnight
+PERIODS = [
+    (7.5, 9.5, "Morning Peak", "red"),
+    (11, 14, "Off Peak", "green"),
+    (17, 18.5, "Evening Peak", "orange"),
+]
+
+COLORS = plotly.colors.qualitative.Plotly
+
+
+def color_map(counts):
+    # Same color for a group in every facet
+    groups = list(dict.fromkeys(counts['color']))
+    return {group: COLORS[i % len(COLORS)] for i, group in enumerate(groups)}
+
+
+def histogram_figure(counts, time_bin, title, boxes=None, yaxis_title='count'):
+    # Facet per label with one stacked bar trace per color, built from pre-aggregated counts.
+    # time_range holds int seconds since midnight, plot it as hours (values past 24 are after midnight)
+    labels = list(dict.fromkeys(counts['label']))
+    colors = color_map(counts)
+    rows = 2 if boxes is not None else 1
+    fig = make_subplots(
+        rows=rows, cols=max(len(labels), 1),
+        shared_xaxes=True, shared_yaxes=True,
+        row_heights=[0.25, 0.75] if boxes is not None else None,
+        vertical_spacing=0.03, horizontal_spacing=0.02,
+        column_titles=[str(label) for label in labels],
+    )
+
+    for col, label in enumerate(labels, start=1):
+        label_counts = counts[counts['label'] == label]
+        for group, color in colors.items():
+            group_counts = label_counts[label_counts['color'] == group]
+            if group_counts.empty:
+                continue
+            fig.add_trace(go.Bar(
+                x=group_counts['time_range'] / 3600,
+                y=group_counts['count'],
+                width=time_bin / 60,
+                offset=0,
+                name=str(group),
+                legendgroup=str(group),
+                showlegend=col == 1,
+                marker_color=color,
+            ), row=rows, col=col)
+
+        if boxes is not None:
+            for box in boxes[boxes['label'] == label].itertuples():
+                fig.add_trace(go.Box(
+                    y=[str(box.color)],
+                    q1=[box.q1 / 3600], median=[box.median / 3600], q3=[box.q3 / 3600],
+                    lowerfence=[box.lowerfence / 3600], upperfence=[box.upperfence / 3600],
+                    mean=[box.mean / 3600],
+                    orientation='h',
+                    name=str(box.color),
+                    legendgroup=str(box.color),
+                    showlegend=False,
+                    marker_color=colors.get(box.color),
+                ), row=1, col=col)
+
+    fig.update_layout(title=title, barmode='stack', bargap=0)
+    fig.update_xaxes(title_text='Hour of day', row=rows)
+    fig.update_yaxes(title_text=yaxis_title, row=rows, col=1)
+    if boxes is not None:
+        fig.update_yaxes(showticklabels=False, row=1)
+    return fig
+
+
+def axis_ref(axis):
+    # 'xaxis3' layout name -> 'x3' trace reference
+    return axis.plotly_name.replace('axis', '')
+
+
+@instrumented('cube_view', payload=True)
+def cube_view(cube):
+    # Everything the browser needs besides the counts: the layout of the trip-count figure
+    # and which subplot axes belong to each label
+    fig = histogram_figure(cube_counts(cube, TOTAL, DEFAULT_TIME_BIN), DEFAULT_TIME_BIN,
+                           "Distribution of Trips Across Scenarios", cube_boxes(cube, TOTAL))
+    fig.update_layout(height=600)
+    counts = cube['dimensions'][TOTAL]['time']
+    add_periods(fig, max(counts) / 3600 if counts else 0)
+
+    view = dict(cube, layout=fig.layout.to_plotly_json(), colors=COLORS, axes=[])
+    for col in range(1, len(cube['labels']) + 1):
+        bar = fig.get_subplot(2, col)
+        box = fig.get_subplot(1, col)
+        view['axes'].append({
+            'bar': [axis_ref(bar.xaxis), axis_ref(bar.yaxis)],
+            'box': [axis_ref(box.xaxis), axis_ref(box.yaxis)],
+        })
+    return view
+
+
+def add_periods(fig, x_max):
+    # Check if the maximum value of x-axis data is greater than the threshold
+    for x0, x1, text, color in PERIODS:
+        if x_max >= x1:
+            fig.add_vrect(x0=x0, x1=x1,
+                          annotation_text=text,
+                          fillcolor=color, opacity=0.25, line_width=0)
+
+
+@instrumented('create_histogram_plot', payload=True)
+def create_histogram_plot(combined_data, color_value, time_bin=DEFAULT_TIME_BIN):
+    # Counts and box statistics are computed here, so the figure size does not depend on the number of trips
+    counts = time_counts(combined_data, color_value)
+    boxes = time_box_stats(combined_data, color_value)
+
+    fig = histogram_figure(counts, time_bin, "Distribution of Trips Across Scenarios", boxes)
             
     fig.update_layout(height=600) 
 
-    # Check if the maximum value of x-axis data is greater than the threshold
-    if x_max >= pd.Timestamp("1900-01-01 09:30:00"):
-        fig.add_vrect(x0="1900-01-01 07:30:00", x1="1900-01-01 09:30:00",
-                      annotation_text="Morning Peak",
-                      fillcolor="red", opacity=0.25, line_width=0)
-
-    if x_max >= pd.Timestamp("1900-01-01 14:00:00"):
-        fig.add_vrect(x0="1900-01-01 11:00:00", x1="1900-01-01 14:00:00",
-                      annotation_text="Off Peak",
-                      fillcolor="green", opacity=0.25, line_width=0)
-
-    if x_max >= pd.Timestamp("1900-01-01 18:30:00"):
-        fig.add_vrect(x0="1900-01-01 17:00:00", x1="1900-01-01 18:30:00",
-                      annotation_text="Evening Peak",
-                      fillcolor="orange", opacity=0.25, line_width=0)
+    add_periods(fig, counts['time_range'].max() / 3600 if len(counts) else 0)
     
     return fig
 
 
 
 
-def stacked_histogram(combined_data, color_value):
-    fig_2 = px.histogram(combined_data, 
-                   facet_col='label',
-                   title="Distribution of Trips Across Scenarios",
-                   x="time_range",
-                   barnorm ='percent',
-                   color=color_value,
-                   nbins=10)
-    fig_2.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+@instrumented('stacked_histogram', payload=True)
+def stacked_histogram(combined_data, color_value, time_bin=DEFAULT_TIME_BIN):
+    counts = percent_of_bin(time_counts(combined_data, color_value))
+    fig_2 = histogram_figure(counts, time_bin, "Distribution of Trips Across Scenarios", yaxis_title='percent')
     
     return fig_2
-    
-    
-    
-    
-
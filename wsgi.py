@@ -1,4 +1,21 @@
-from .app import server as application
+import logging
+import time
+
+started = time.perf_counter()
+
+from app import server as application
+import health
+from reference_data import get_reference_data
+
+health.import_seconds = round(time.perf_counter() - started, 3)
+logging.getLogger(__name__).info('App imported in %.2f s', health.import_seconds)
+
+# Warm the reference-data registry when gunicorn imports the app. With --preload this runs once in the
+# master, and the workers inherit the loaded tables copy-on-write when they are forked.
+try:
+    get_reference_data()
+except FileNotFoundError as error:
+    logging.getLogger(__name__).warning('Reference data not preloaded: %s', error)
 
 if __name__ == '__main__':
-    application.run()
\ No newline at end of file
+    application.run()